@@ -0,0 +1,140 @@
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import click
+import numpy as np
+import sqlalchemy
+from gist.core import get_gist_score
+from gist.repo import CritRepo, EhrRepo
+from gist.weights import WEIGHT_BACKENDS, get_weight_backend
+from gist.profiling import enable_profiling, disable_profiling
+from benchmarks.synthetic import generate_database
+
+logger = logging.getLogger(__name__)
+
+# bumped when the generator changes, so databases generated by an older one are not reused
+SYNTHETIC_VERSION = 2
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_database(db_dir, num_persons, num_trials, seed, conn_str=None):
+    if (conn_str is not None):
+        start = time.perf_counter()
+        trial_ids = generate_database(conn_str, num_persons, num_trials, seed)
+        return (conn_str, trial_ids, time.perf_counter() - start)
+    path = os.path.join(db_dir, f"synthetic-v{SYNTHETIC_VERSION}-{num_persons}-{num_trials}-{seed}.db")
+    conn_str = f"sqlite:///{path}"
+    if (os.path.exists(path)):
+        logger.info(f"reusing {path}")
+        return (conn_str, CritRepo(conn_str).get_all_trial_ids(), None)
+    start = time.perf_counter()
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    trial_ids = generate_database(f"sqlite:///{tmp_path}", num_persons, num_trials, seed)
+    os.replace(tmp_path, path)
+    return (conn_str, trial_ids, time.perf_counter() - start)
+
+
+def run_benchmark(conn_str, trial_ids, weight_backend, orm_max_persons, trace_memory):
+    ehr_repo = EhrRepo(conn_str)
+    crit_repo = CritRepo(conn_str)
+    criteria_by_trial_ids = crit_repo.get_criteria_by_trial_ids(trial_ids)
+
+    profiler = enable_profiling(trace_memory)
+    try:
+        snapshot = ehr_repo.get_ehr_snapshot()
+        for criteria_by_trial_id in criteria_by_trial_ids:
+            get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], snapshot, weight_backend)
+        for criteria_by_trial_id in criteria_by_trial_ids:
+            ehr_repo.get_ehr_elig_flags(criteria_by_trial_id['criteria'])
+        if (len(snapshot) <= orm_max_persons):
+            ehr = ehr_repo.get_ehr()
+            for criteria_by_trial_id in criteria_by_trial_ids:
+                get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr, weight_backend)
+        else:
+            logger.info(f"skipping the ORM loader above {orm_max_persons} persons")
+        report = profiler.get_report()
+    finally:
+        disable_profiling()
+    report['persons'] = len(snapshot)
+    report['rows'] = {domain_id: len(rows) for domain_id, rows in snapshot.domains.items()}
+    report['eras'] = {
+        'occurrences': run_snapshot_benchmark(ehr_repo, criteria_by_trial_ids, weight_backend, trace_memory),
+        'eras': run_snapshot_benchmark(ehr_repo, criteria_by_trial_ids, weight_backend, trace_memory, ehr_repo.get_available_era_domain_ids()),
+    }
+    return report
+
+
+def run_snapshot_benchmark(ehr_repo, criteria_by_trial_ids, weight_backend, trace_memory, era_domain_ids=()):
+    # the snapshot path alone, so reading condition and drug rows from occurrences and from eras compare stage by stage
+    ehr_repo.era_domain_ids = era_domain_ids
+    profiler = enable_profiling(trace_memory)
+    try:
+        snapshot = ehr_repo.get_ehr_snapshot()
+        for criteria_by_trial_id in criteria_by_trial_ids:
+            get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], snapshot, weight_backend)
+        report = profiler.get_report()
+    finally:
+        disable_profiling()
+        ehr_repo.era_domain_ids = ()
+    report['era_domain_ids'] = list(era_domain_ids)
+    report['rows'] = {domain_id: len(rows) for domain_id, rows in snapshot.domains.items()}
+    return report
+
+
+@click.command()
+@click.option('-n', '--num-persons', 'scales', type=int, multiple=True, default=[1000, 10000], help="Number of synthetic persons. Repeat for several scales")
+@click.option('--num-trials', type=int, default=20, help="Number of synthetic trials")
+@click.option('--seed', type=int, default=0, help="Seed of the synthetic data")
+@click.option('--db-dir', type=click.Path(file_okay=False), default='.benchmarks', help="Directory the synthetic SQLite databases are generated into and reused from")
+@click.option('--conn-str', help="Generate into this database, e.g. a local PostgreSQL, instead of SQLite files. Its GIST tables are dropped and regenerated for every scale")
+@click.option('--weight-backend', type=click.Choice(list(WEIGHT_BACKENDS)), default='linear', help="Weight backend used for scoring. The exact svc backend does not scale to the larger populations")
+@click.option('--orm-max-persons', type=int, default=10000, help="Largest population the ORM loader is benchmarked on")
+@click.option('--trace-memory', is_flag=True, help="Record tracemalloc peaks. Slows down Python heavy stages")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help="JSON file the results are written to")
+def run(scales, num_trials, seed, db_dir, conn_str, weight_backend, orm_max_persons, trace_memory, output):
+    """Time each stage of GIST on synthetic OMOP CDM populations."""
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    os.makedirs(db_dir, exist_ok=True)
+    results = {
+        'commit': get_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sqlalchemy': sqlalchemy.__version__,
+        'weight_backend': weight_backend,
+        'num_trials': num_trials,
+        'seed': seed,
+        'scales': [],
+    }
+    for num_persons in scales:
+        db_conn_str, trial_ids, generate_seconds = get_database(db_dir, num_persons, num_trials, seed, conn_str)
+        report = run_benchmark(db_conn_str, trial_ids, get_weight_backend(weight_backend), orm_max_persons, trace_memory)
+        report['generate_seconds'] = generate_seconds
+        results['scales'].append(report)
+        stage_seconds = {stage: round(stats['wall_seconds'], 3) for stage, stats in report['stages'].items()}
+        logger.info(f"{num_persons} persons: {stage_seconds}")
+        for source, source_report in report['eras'].items():
+            source_seconds = {stage: round(source_report['stages'][stage]['wall_seconds'], 3) for stage in ('EhrRepo.get_ehr_snapshot', 'get_elig_matrix', 'get_gist_score')}
+            logger.info(f"{num_persons} persons, condition and drug rows from {source}: {source_seconds}, rows {source_report['rows']}")
+
+    if (output):
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        logger.info(f"wrote results to {output}")
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,209 @@
+import datetime
+import logging
+import numpy as np
+from sqlalchemy import create_engine, Column, MetaData, Table, Date, DateTime, String, Text, insert
+from gist.entities import EligibilityCriterion, Person, ConditionOccurrence, DrugExposure, ProcedureOccurrence, Observation, Measurement, ConceptAncestor, ObservationPeriod, ConditionEra, DrugEra
+from gist.core import AGE_CONCEPT_ID, GENDER_CONCEPT_ID, MALE_GENDER_CONCEPT_ID, FEMALE_GENDER_CONCEPT_ID
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH_SIZE = 50000
+FIRST_DATE = np.datetime64('2010-01-01')
+NUM_DAYS = 3650
+
+# (entity, pk, concept, value and date columns, first concept_id, number of concepts, mean rows per person) of each generated clinical domain
+DOMAIN_SPECS = {
+    'Condition': (ConditionOccurrence, 'condition_occurrence_id', 'condition_concept_id', None, 'condition_start_date', 100000, 1000, 4.0),
+    'Drug': (DrugExposure, 'drug_exposure_id', 'drug_concept_id', None, 'drug_exposure_start_date', 200000, 800, 5.0),
+    'Procedure': (ProcedureOccurrence, 'procedure_occurrence_id', 'procedure_concept_id', None, 'procedure_date', 300000, 500, 2.0),
+    'Observation': (Observation, 'observation_id', 'observation_concept_id', 'value_as_number', 'observation_date', 400000, 300, 2.0),
+    'Measurement': (Measurement, 'measurement_id', 'measurement_concept_id', 'value_as_number', 'measurement_date', 500000, 50, 6.0),
+}
+# (entity, pk, concept, start date, end date and count columns) of the era table built from a generated domain
+ERA_SPECS = {
+    'Condition': (ConditionEra, 'condition_era_id', 'condition_concept_id', 'condition_era_start_date', 'condition_era_end_date', 'condition_occurrence_count'),
+    'Drug': (DrugEra, 'drug_era_id', 'drug_concept_id', 'drug_era_start_date', 'drug_era_end_date', 'drug_exposure_count'),
+}
+# rows of one person and concept at most this many days apart are collapsed into one era, as by the OHDSI era scripts
+ERA_PERSISTENCE_DAYS = 30
+# fraction of condition and drug rows that recur within the persistence window of the person's previous row
+RECURRENCE_FRACTION = 0.5
+CONDITION_GROUP_SIZE = 10
+
+
+def get_schema_tables(metadata):
+    """Copies of the tables GIST reads, without the foreign keys into the vocabulary and the PostgreSQL only check constraints."""
+    tables = {}
+    for entity in (Person, ConditionOccurrence, DrugExposure, ProcedureOccurrence, Observation, Measurement, ConceptAncestor, ObservationPeriod, ConditionEra, DrugEra, EligibilityCriterion):
+        table = entity.__table__
+        tables[entity] = Table(table.name, metadata, *[Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable, index=column.index) for column in table.columns])
+    return tables
+
+
+def get_column_defaults(table):
+    defaults = {}
+    for column in table.columns:
+        if (column.nullable or column.primary_key):
+            continue
+        if (isinstance(column.type, DateTime)):
+            defaults[column.name] = datetime.datetime(2010, 1, 1)
+        elif (isinstance(column.type, Date)):
+            defaults[column.name] = datetime.date(2010, 1, 1)
+        elif (isinstance(column.type, (String, Text))):
+            defaults[column.name] = ''
+        else:
+            defaults[column.name] = 0
+    return defaults
+
+
+def insert_columns(conn, table, columns):
+    defaults = get_column_defaults(table)
+    names = list(columns)
+    num_rows = len(columns[names[0]]) if names else 0
+    for start in range(0, num_rows, INSERT_BATCH_SIZE):
+        values = [column[start:start + INSERT_BATCH_SIZE].tolist() for column in columns.values()]
+        rows = [dict(defaults, **dict(zip(names, row))) for row in zip(*values)]
+        conn.execute(insert(table), rows)
+    logger.debug(f"inserted {num_rows} rows into {table.name}")
+
+
+def to_dates(days):
+    return (FIRST_DATE + days.astype('timedelta64[D]')).astype(object)
+
+
+def get_zipf_concept_ids(rng, first_concept_id, num_concepts, size):
+    ranks = np.arange(1, num_concepts + 1)
+    probabilities = 1 / ranks / (1 / ranks).sum()
+    return first_concept_id + rng.choice(num_concepts, size=size, p=probabilities)
+
+
+def get_lab_distributions(num_labs, seed):
+    rng = np.random.default_rng(seed + 1)
+    return (rng.uniform(5, 200, num_labs), rng.uniform(1, 30, num_labs))
+
+
+def add_recurrences(rng, person_ids, concept_ids, days):
+    # a recurring row repeats the concept of the last new row of the person, some days after the row before it
+    is_recurrence = rng.random(len(days)) < RECURRENCE_FRACTION
+    is_recurrence[0:1] = False
+    is_recurrence[1:] &= person_ids[1:] == person_ids[:-1]
+    positions = np.arange(len(days))
+    anchors = np.maximum.accumulate(np.where(is_recurrence, 0, positions)) if len(days) else positions
+    gaps = np.cumsum(np.where(is_recurrence, rng.integers(1, ERA_PERSISTENCE_DAYS + 1, len(days)), 0))
+    return (concept_ids[anchors], days[anchors] + gaps - gaps[anchors])
+
+
+def get_eras(person_ids, concept_ids, days):
+    order = np.lexsort((days, concept_ids, person_ids))
+    person_ids, concept_ids, days = person_ids[order], concept_ids[order], days[order]
+    is_start = np.ones(len(days), dtype=bool)
+    is_start[1:] = (person_ids[1:] != person_ids[:-1]) | (concept_ids[1:] != concept_ids[:-1]) | (days[1:] - days[:-1] > ERA_PERSISTENCE_DAYS)
+    starts = np.flatnonzero(is_start)
+    end_days = np.maximum.reduceat(days, starts) if len(starts) else days[starts]
+    return (person_ids[starts], concept_ids[starts], days[starts], end_days, np.diff(np.append(starts, len(days))))
+
+
+def generate_eras(conn, tables, domain_id, person_ids, concept_ids, days):
+    entity, pk, concept_id, start_date, end_date, count = ERA_SPECS[domain_id]
+    era_person_ids, era_concept_ids, start_days, end_days, counts = get_eras(person_ids, concept_ids, days)
+    insert_columns(conn, tables[entity], {
+        pk: np.arange(1, len(era_person_ids) + 1),
+        'person_id': era_person_ids,
+        concept_id: era_concept_ids,
+        start_date: to_dates(start_days),
+        end_date: to_dates(end_days),
+        count: counts,
+    })
+    logger.info(f"generated {len(era_person_ids)} {entity.__tablename__} rows from {len(days)} {domain_id} rows")
+
+
+def generate_ehr(conn, tables, num_persons, seed):
+    rng = np.random.default_rng(seed)
+    person_ids = np.arange(1, num_persons + 1)
+    insert_columns(conn, tables[Person], {
+        'person_id': person_ids,
+        'year_of_birth': rng.integers(1930, 2006, num_persons),
+        'gender_source_concept_id': rng.choice([MALE_GENDER_CONCEPT_ID, FEMALE_GENDER_CONCEPT_ID], num_persons),
+    })
+    start_days = rng.integers(0, NUM_DAYS // 2, num_persons)
+    insert_columns(conn, tables[ObservationPeriod], {
+        'observation_period_id': person_ids,
+        'person_id': person_ids,
+        'observation_period_start_date': to_dates(start_days),
+        'observation_period_end_date': to_dates(start_days + rng.integers(365, NUM_DAYS // 2, num_persons)),
+    })
+
+    lab_means, lab_std_devs = get_lab_distributions(DOMAIN_SPECS['Measurement'][6], seed)
+    # recurrences draw from their own generator, so the other domains are generated as before
+    recurrence_rng = np.random.default_rng(seed + 3)
+    for domain_id, (entity, pk, concept_id, value, date, first_concept_id, num_concepts, rows_per_person) in DOMAIN_SPECS.items():
+        counts = rng.poisson(rows_per_person, num_persons)
+        num_rows = int(counts.sum())
+        concept_ids = get_zipf_concept_ids(rng, first_concept_id, num_concepts, num_rows)
+        days = rng.integers(0, NUM_DAYS, num_rows)
+        columns = {
+            pk: np.arange(1, num_rows + 1),
+            'person_id': np.repeat(person_ids, counts),
+            concept_id: concept_ids,
+            date: to_dates(days),
+        }
+        if (domain_id in ERA_SPECS):
+            columns[concept_id], days = add_recurrences(recurrence_rng, columns['person_id'], columns[concept_id], days)
+            columns[date] = to_dates(days)
+        if (domain_id == 'Measurement'):
+            lab_index = columns[concept_id] - first_concept_id
+            values = np.round(rng.normal(lab_means[lab_index], lab_std_devs[lab_index]), 2)
+            columns[value] = np.where(rng.random(num_rows) < 0.02, None, values)
+        elif (value is not None):
+            columns[value] = np.round(rng.random(num_rows), 4)
+        insert_columns(conn, tables[entity], columns)
+        logger.info(f"generated {num_rows} {domain_id} rows")
+        if (domain_id in ERA_SPECS):
+            generate_eras(conn, tables, domain_id, columns['person_id'], columns[concept_id], days)
+
+    first_concept_id, num_concepts = DOMAIN_SPECS['Condition'][5:7]
+    concept_ids = first_concept_id + np.arange(num_concepts)
+    group_ids = first_concept_id + num_concepts + (concept_ids - first_concept_id) // CONDITION_GROUP_SIZE
+    all_concept_ids = np.concatenate((concept_ids, np.unique(group_ids)))
+    insert_columns(conn, tables[ConceptAncestor], {
+        'ancestor_concept_id': np.concatenate((all_concept_ids, group_ids)),
+        'descendant_concept_id': np.concatenate((all_concept_ids, concept_ids)),
+        'min_levels_of_separation': np.concatenate((np.zeros(len(all_concept_ids), dtype=np.int64), np.ones(num_concepts, dtype=np.int64))),
+        'max_levels_of_separation': np.concatenate((np.zeros(len(all_concept_ids), dtype=np.int64), np.ones(num_concepts, dtype=np.int64))),
+    })
+
+
+def generate_criteria(conn, tables, num_trials, seed):
+    rng = np.random.default_rng(seed + 2)
+    lab_means, lab_std_devs = get_lab_distributions(DOMAIN_SPECS['Measurement'][6], seed)
+    rows = []
+    for trial in range(num_trials):
+        nct_id = f"NCT{90000000 + trial:08d}"
+        min_age = int(rng.integers(18, 50))
+        rows.append((nct_id, 'age', AGE_CONCEPT_ID, 'Observation', 1, min_age, min_age + int(rng.integers(15, 50))))
+        rows.append((nct_id, 'gender', GENDER_CONCEPT_ID, 'Observation', int(rng.choice([0, 0, 1, 2])), None, None))
+        for domain_id, num_criteria in (('Condition', rng.integers(1, 4)), ('Drug', rng.integers(0, 3)), ('Procedure', rng.integers(0, 2)), ('Observation', rng.integers(0, 2))):
+            first_concept_id, num_concepts = DOMAIN_SPECS[domain_id][5:7]
+            for concept_index in rng.choice(num_concepts // 10, num_criteria, replace=False):
+                rows.append((nct_id, f"{domain_id.lower()} {concept_index}", first_concept_id + int(concept_index), domain_id, 1, None, None))
+        first_concept_id, num_labs = DOMAIN_SPECS['Measurement'][5:7]
+        for lab_index in rng.choice(num_labs, rng.integers(1, 4), replace=False):
+            center = lab_means[lab_index] + rng.normal(0, lab_std_devs[lab_index] / 2)
+            half_width = lab_std_devs[lab_index] * rng.uniform(0.5, 2)
+            rows.append((nct_id, f"lab {lab_index}", first_concept_id + int(lab_index), 'Measurement', int(rng.choice([0, 1], p=[0.2, 0.8])), int(center - half_width), int(np.ceil(center + half_width))))
+    conn.execute(insert(tables[EligibilityCriterion]), [dict(zip(('nct_id', 'concept_name', 'concept_id', 'domain_id', 'cat_elig', 'lab_elig_min', 'lab_elig_max'), row)) for row in rows])
+    logger.info(f"generated {len(rows)} criteria of {num_trials} trials")
+    return [f"NCT{90000000 + trial:08d}" for trial in range(num_trials)]
+
+
+def generate_database(conn_str, num_persons, num_trials=20, seed=0):
+    engine = create_engine(conn_str)
+    metadata = MetaData()
+    tables = get_schema_tables(metadata)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        generate_ehr(conn, tables, num_persons, seed)
+        trial_ids = generate_criteria(conn, tables, num_trials, seed)
+    engine.dispose()
+    return trial_ids
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from collections import defaultdict
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from gist.entities import EligibilityCriterion, Person, ConditionOccurrence, DrugExposure, Measurement, Observation, ProcedureOccurrence
+from gist.labs import DEFAULT_LAB_VALUE_POLICY
+from gist.repo import FETCH_PARTITION_SIZE, DOMAIN_COLUMNS
+from gist.snapshot import build_snapshot, to_int_array, to_float_array, to_date_array
+
+MAX_CONCURRENT_QUERIES = 8
+
+# asyncio driver used for each synchronous driver name
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+# Person relationship loaded with the ORM rows of each clinical domain
+DOMAIN_RELATIONSHIPS = {
+    'Condition': ('condition_occurrence', ConditionOccurrence),
+    'Drug': ('drug_exposure', DrugExposure),
+    'Procedure': ('procedure_occurrence', ProcedureOccurrence),
+    'Observation': ('observation', Observation),
+    'Measurement': ('measurement', Measurement),
+}
+
+
+def get_async_conn_str(conn_str):
+    url = make_url(conn_str)
+    if (url.get_backend_name() in ASYNC_DRIVERS and '+' not in url.drivername):
+        url = url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+    return str(url)
+
+
+class AsyncRepo:
+
+    def __init__(self, conn_str, max_concurrent_queries=MAX_CONCURRENT_QUERIES):
+        self.conn_str = conn_str
+        self.engine = create_async_engine(get_async_conn_str(conn_str))
+        self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.semaphore = asyncio.Semaphore(max_concurrent_queries)
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+
+class AsyncCritRepo(AsyncRepo):
+
+    async def get_criteria_by_trial_id(self, trial_id):
+        stmt = (
+            select(EligibilityCriterion)
+            .filter(EligibilityCriterion.nct_id == trial_id)
+        )
+        logging.debug(f"query for get_criteria_by_trial_id: {stmt}")
+        async with self.semaphore, self.session() as session:
+            trials = (await session.execute(stmt)).scalars().all()
+        return trials
+
+    async def get_criteria_by_trial_ids(self, trial_ids):
+        criteria = await asyncio.gather(*[self.get_criteria_by_trial_id(trial_id) for trial_id in trial_ids])
+        return [{'trial_id': trial_id, 'criteria': trial_criteria} for trial_id, trial_criteria in zip(trial_ids, criteria)]
+
+
+class AsyncEhrRepo(AsyncRepo):
+
+    def __init__(self, conn_str, max_concurrent_queries=MAX_CONCURRENT_QUERIES):
+        super().__init__(conn_str, max_concurrent_queries)
+        self.concept_closure = None
+        self.lab_value_policy = DEFAULT_LAB_VALUE_POLICY
+
+    async def get_ehr(self):
+        stmt = select(Person).order_by(Person.person_id)
+        logging.debug(f"query for get_ehr: {stmt}")
+        fetches = [self._fetch_persons(stmt)] + [self._fetch_domain_objects(domain_id) for domain_id in DOMAIN_RELATIONSHIPS]
+        persons, *domain_objects = await asyncio.gather(*fetches)
+        for (attribute, _), rows_by_person_id in zip(DOMAIN_RELATIONSHIPS.values(), domain_objects):
+            for person in persons:
+                set_committed_value(person, attribute, rows_by_person_id.get(person.person_id, []))
+        return persons
+
+    async def get_ehr_snapshot(self):
+        stmt = (
+            select(Person.person_id, Person.year_of_birth, Person.gender_source_concept_id)
+            .order_by(Person.person_id)
+        )
+        logging.debug(f"query for get_ehr_snapshot: {stmt}")
+        fetches = [self._fetch_columns(stmt, 3)] + [self._fetch_domain_columns(domain_id) for domain_id in DOMAIN_COLUMNS]
+        (person_ids, year_of_birth, gender_source_concept_ids), *domain_columns = await asyncio.gather(*fetches)
+        person_columns = (to_int_array(person_ids), to_int_array(year_of_birth), to_int_array(gender_source_concept_ids))
+        snapshot = build_snapshot(person_columns, dict(zip(DOMAIN_COLUMNS, domain_columns)))
+        snapshot.concept_closure = self.concept_closure
+        snapshot.lab_value_policy = self.lab_value_policy
+        return snapshot
+
+    async def _fetch_persons(self, stmt):
+        async with self.semaphore, self.session() as session:
+            return (await session.execute(stmt)).scalars().all()
+
+    async def _fetch_domain_objects(self, domain_id):
+        attribute, entity = DOMAIN_RELATIONSHIPS[domain_id]
+        pk, person_id = DOMAIN_COLUMNS[domain_id][:2]
+        stmt = select(entity).order_by(person_id, pk)
+        logging.debug(f"query for {domain_id} objects: {stmt}")
+        rows_by_person_id = defaultdict(list)
+        async with self.semaphore, self.session() as session:
+            result = await session.stream(stmt)
+            async for partition in result.scalars().partitions(FETCH_PARTITION_SIZE):
+                for row in partition:
+                    rows_by_person_id[row.person_id].append(row)
+        return rows_by_person_id
+
+    async def _fetch_domain_columns(self, domain_id):
+        pk, person_id, concept_id, value, date = DOMAIN_COLUMNS[domain_id]
+        columns = [person_id, concept_id, date] if value is None else [person_id, concept_id, date, value]
+        stmt = (
+            select(*columns)
+            .order_by(person_id, pk)
+        )
+        logging.debug(f"query for {domain_id} rows: {stmt}")
+        fetched = await self._fetch_columns(stmt, len(columns))
+        values = to_float_array(fetched[3]) if value is not None else np.full(len(fetched[0]), np.nan)
+        return (to_int_array(fetched[0]), to_int_array(fetched[1]), values, to_date_array(fetched[2]))
+
+    async def _fetch_columns(self, stmt, num_columns):
+        columns = [[] for _ in range(num_columns)]
+        async with self.semaphore, self.engine.connect() as conn:
+            result = await conn.stream(stmt)
+            async for partition in result.partitions(FETCH_PARTITION_SIZE):
+                for column, values in zip(columns, zip(*partition)):
+                    column.extend(values)
+        return columns
+
+
+async def fetch_criteria_and_ehr(crit_conn_str, ehr_conn_str, trial_ids, fetch_ehr=True, orm=False):
+    crit_repo = AsyncCritRepo(crit_conn_str)
+    ehr_repo = AsyncEhrRepo(ehr_conn_str)
+    try:
+        fetches = [crit_repo.get_criteria_by_trial_ids(trial_ids)]
+        if (fetch_ehr):
+            fetches.append(ehr_repo.get_ehr() if orm else ehr_repo.get_ehr_snapshot())
+        criteria_by_trial_ids, *ehr = await asyncio.gather(*fetches)
+    finally:
+        await asyncio.gather(crit_repo.dispose(), ehr_repo.dispose())
+    return (criteria_by_trial_ids, ehr[0] if ehr else None)
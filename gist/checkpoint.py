@@ -0,0 +1,57 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class ScoreCheckpoint:
+    """JSON lines file of finished gist scores, appended and fsynced after every batch of trials.
+
+    Trials saved with an error are not finished, so a resumed run scores them again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.trial_ids = set()
+        self.error_trial_ids = set()
+        if (os.path.exists(path)):
+            self.load()
+
+    def __contains__(self, trial_id):
+        return trial_id in self.trial_ids
+
+    def __len__(self):
+        return len(self.trial_ids)
+
+    @property
+    def num_errors(self):
+        return len(self.error_trial_ids)
+
+    def load(self):
+        with open(self.path, 'rb+') as checkpoint_file:
+            lines = checkpoint_file.read().split(b'\n')
+            if (lines[-1]):
+                # a crash during the last write left a partial line behind, drop it before appending
+                logger.warning(f"dropping truncated last line of checkpoint {self.path}")
+                checkpoint_file.truncate(checkpoint_file.tell() - len(lines[-1]))
+        for line in lines[:-1]:
+            self.add(json.loads(line))
+        logger.info(f"resuming from checkpoint {self.path} with {len(self.trial_ids)} scored trials, retrying {self.num_errors} failed trials")
+
+    def write_batch(self, gist_scores):
+        with open(self.path, 'a') as checkpoint_file:
+            for gist_score in gist_scores:
+                checkpoint_file.write(json.dumps(gist_score) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        for gist_score in gist_scores:
+            self.add(gist_score)
+
+    def add(self, gist_score):
+        # lines are in write order, so a later score of a retried trial replaces its error
+        if ('error' in gist_score):
+            self.error_trial_ids.add(gist_score['trial_id'])
+        else:
+            self.trial_ids.add(gist_score['trial_id'])
+            self.error_trial_ids.discard(gist_score['trial_id'])
@@ -1,43 +1,359 @@
+import asyncio
+import functools
+import json
 import os
 import logging
 import click
 import os
-from gist.core import get_gist_score
+from gist.core import get_gist_score, get_gist_scores, is_presence_criterion, get_lab_criteria, get_lab_stats, get_features_and_labels
 from gist.repo import CritRepo, EhrRepo
+from gist.async_repo import fetch_criteria_and_ehr
+from gist.checkpoint import ScoreCheckpoint
+from gist.results import ResultStore, get_settings_hash
+from gist import profiling
+from gist.profiling import enable_profiling, disable_profiling, write_json_report, write_prometheus_textfile
+from gist.impact import get_criterion_impacts, get_incremental_scorer
+from gist.sweep import get_lab_range_curves
+from gist.stream import get_streamed_gist_score
+from gist.sampling import get_sampled_gist_scores
+from gist.eras import get_era_differences
+from gist.pool import get_pooled_gist_scores
+from gist.labs import LAB_VALUE_POLICIES, DEFAULT_LAB_VALUE_POLICY
+from gist.snapshot import DOMAIN_IDS
+from gist.weights import WEIGHT_BACKENDS, WeightCache, get_weight_backend, compare_weight_backends
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
 logger = logging.getLogger(__name__)
 
-@click.command()
+
+def parse_lookback_days(ctx, param, values):
+    lookback_days = {}
+    for value in values:
+        domain_id, _, days = value.partition('=')
+        if (domain_id not in DOMAIN_IDS or not days.isdigit()):
+            raise click.BadParameter(f"expected DOMAIN=DAYS with DOMAIN one of {', '.join(DOMAIN_IDS)}, got {value}")
+        lookback_days[domain_id] = int(days)
+    return lookback_days
+
+
+# click 7 FloatRange has no open bounds, so they are checked here
+def check_sample_fraction(ctx, param, value):
+    if (value is not None and not 0 < value <= 1):
+        raise click.BadParameter(f"expected a fraction in (0, 1], got {value}")
+    return value
+
+
+def check_confidence(ctx, param, value):
+    if (not 0 < value < 1):
+        raise click.BadParameter(f"expected a confidence level in (0, 1), got {value}")
+    return value
+
+
+@click.group(invoke_without_command=True)
 @click.option('-d', '--debug', is_flag=True, envvar="GIST_DEBUG", help="Show debug output. Automatically pulls from environment")
 @click.option('-ehr', '--ehr-conn-str', required=True, envvar="GIST_EHR_CONN_STR", help="EHR db connection string. Automatically pulls from current environment")
 @click.option('-crit', '--crit-conn-str', required=True, envvar="GIST_CRIT_CONN_STR", help="CRIT db connection string. Automatically pulls from current environment")
-@click.option('-t', '--trial_id', 'trial_ids', required=True, multiple=True, envvar="GIST_TRIAL_IDS", help="Trial ID(s)")
-def cli(debug, trial_ids, ehr_conn_str, crit_conn_str):
+@click.option('-t', '--trial_id', 'trial_ids', multiple=True, envvar="GIST_TRIAL_IDS", help="Trial ID(s)")
+@click.option('--orm', is_flag=True, envvar="GIST_ORM", help="Load the EHR as ORM Person objects instead of a columnar snapshot. Slow, meant for small debugging runs")
+@click.option('--pushdown', is_flag=True, envvar="GIST_PUSHDOWN", help="Compute eligibility flags inside the EHR database with one aggregate query per trial instead of loading the EHR")
+@click.option('--chunk-size', type=int, envvar="GIST_CHUNK_SIZE", help="Stream the EHR in chunks of this many persons so memory is bounded by the chunk size instead of the EHR size")
+@click.option('--cache-dir', type=click.Path(file_okay=False), envvar="GIST_CACHE_DIR", help="Directory of memory-mapped EHR snapshots keyed by a fingerprint of the EHR database. Reused while the EHR is unchanged")
+@click.option('-w', '--workers', type=int, default=1, envvar="GIST_WORKERS", help="Score trials in a pool of this many processes sharing the loaded EHR")
+@click.option('--weight-backend', type=click.Choice(list(WEIGHT_BACKENDS)), default='svc', envvar="GIST_WEIGHT_BACKEND", help="Model used to learn population weights. svc is exact, the others scale to large populations")
+@click.option('--weight-sample-size', type=int, default=10000, envvar="GIST_WEIGHT_SAMPLE_SIZE", help="Number of persons the subsample weight backend fits on")
+@click.option('--compare-weights', is_flag=True, help="Report how far each weight backend's weights deviate from the exact svc weights for every trial")
+@click.option('--weight-cache-dir', type=click.Path(file_okay=False), envvar="GIST_WEIGHT_CACHE_DIR", help="Directory of trained weights keyed by lab criteria and EHR snapshot version. Only used with --cache-dir, which gives the snapshot a version")
+@click.option('--descendants', is_flag=True, envvar="GIST_DESCENDANTS", help="Match condition, drug, procedure and observation criteria on the criterion concept and all its descendants in concept_ancestor")
+@click.option('--lab-value-policy', type=click.Choice(LAB_VALUE_POLICIES), default=DEFAULT_LAB_VALUE_POLICY, envvar="GIST_LAB_VALUE_POLICY", help="Which of a person's measurements of a lab concept is used: the latest or earliest by measurement_date, or the mean, min or max")
+@click.option('--impact', is_flag=True, envvar="GIST_IMPACT", help="Report the m-GIST score of every trial with each criterion left out, ranking the criteria that most restrict generalizability")
+@click.option('--async-fetch', is_flag=True, envvar="GIST_ASYNC_FETCH", help="Fetch the criteria of all trials and every clinical domain table concurrently over an asyncio connection pool")
+@click.option('--all-trials', is_flag=True, envvar="GIST_ALL_TRIALS", help="Score every trial in the criteria database in batches instead of the given trial ids")
+@click.option('--batch-size', type=int, default=500, envvar="GIST_BATCH_SIZE", help="Number of trials whose criteria are fetched and scored together by --all-trials")
+@click.option('--checkpoint', 'checkpoint_path', type=click.Path(dir_okay=False), envvar="GIST_CHECKPOINT", help="JSON lines file the scores of --all-trials are appended to after every batch. Trials already in it are skipped, so a stopped run resumes where it left off")
+@click.option('--eras', is_flag=True, envvar="GIST_ERAS", help="Answer Condition and Drug criteria from the smaller condition_era and drug_era tables where they have rows. Check the difference with the verify-eras command")
+@click.option('--index-date', type=click.DateTime(formats=['%Y-%m-%d']), envvar="GIST_INDEX_DATE", help="Evaluate the criteria at this date: ages at the index date and only rows dated on or before it")
+@click.option('--lookback', 'lookback_days', multiple=True, callback=parse_lookback_days, envvar="GIST_LOOKBACK", help="Only count rows of a domain dated within this many days before --index-date, e.g. Condition=365 or Measurement=90. Repeat for several domains")
+@click.option('--observation-period/--no-observation-period', default=True, envvar="GIST_OBSERVATION_PERIOD", help="With --index-date, leave out persons without an observation_period containing the index date and ignore their rows before its start")
+@click.option('--result-store', 'result_store_conn_str', envvar="GIST_RESULT_STORE", help="Database connection string of a gist_result table the scores are stored in, e.g. sqlite:///results.db or the CRIT db. Trials whose criteria, EHR and settings are unchanged since they were stored are not scored again")
+@click.option('--selective-load/--no-selective-load', default=True, envvar="GIST_SELECTIVE_LOAD", help="Load only the condition, drug, procedure, observation and measurement rows of concepts the scored criteria reference. --no-selective-load loads every row, so one cached snapshot serves any trials")
+@click.option('--sample-fraction', type=float, callback=check_sample_fraction, envvar="GIST_SAMPLE_FRACTION", help="Estimate the scores on this fraction of the persons, sampled within birth year bands by gender in the EHR database, and report confidence intervals")
+@click.option('--target-width', type=float, envvar="GIST_TARGET_WIDTH", help="Double --sample-fraction until every confidence interval of a trial is at most this wide")
+@click.option('--confidence', type=float, callback=check_confidence, default=0.95, envvar="GIST_CONFIDENCE", help="Confidence level of the --sample-fraction intervals")
+@click.option('--sample-seed', type=int, default=0, envvar="GIST_SAMPLE_SEED", help="Seed of the --sample-fraction sample. Samples of one seed are nested as the fraction grows")
+@click.option('--profile', is_flag=True, envvar="GIST_PROFILE", help="Record wall time, CPU time, memory peaks and row/person/criterion counts of every stage and log them as JSON at the end of the run")
+@click.option('--profile-output', type=click.Path(dir_okay=False), envvar="GIST_PROFILE_OUTPUT", help="Write the --profile report to this JSON file")
+@click.option('--prometheus-textfile', type=click.Path(dir_okay=False), envvar="GIST_PROMETHEUS_TEXTFILE", help="Write the --profile report in the Prometheus textfile collector format to this file")
+@click.pass_context
+def cli(ctx, debug, trial_ids, ehr_conn_str, crit_conn_str, orm, pushdown, chunk_size, cache_dir, workers, weight_backend, weight_sample_size, compare_weights, weight_cache_dir, descendants, lab_value_policy, impact, async_fetch, all_trials, batch_size, checkpoint_path, eras, index_date, lookback_days, observation_period, result_store_conn_str, selective_load, sample_fraction, target_width, confidence, sample_seed, profile, profile_output, prometheus_textfile):
     """OMOP CDM Based Automatic Clinical Trial Generalizability Assessment Framework."""
 
+    if (not trial_ids and not all_trials):
+        raise click.UsageError("Missing option '-t' / '--trial_id' or '--all-trials'")
+
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
     logger.info(f"logging level set to {'debug' if debug else 'info'}")
 
+    if (profile or profile_output or prometheus_textfile):
+        enable_profiling()
+        ctx.call_on_close(lambda: report_profile(profile_output, prometheus_textfile))
+
+    weight_backend_name = weight_backend
+    weight_backend = get_weight_backend('subsample', sample_size=weight_sample_size) if weight_backend == 'subsample' else get_weight_backend(weight_backend)
+    logger.info(f"using {weight_backend_name} weight backend")
+    weight_cache = WeightCache(cache_dir=weight_cache_dir)
+
     ehr_repo = EhrRepo(ehr_conn_str)
+    ehr_repo.lab_value_policy = lab_value_policy
+    if (eras):
+        ehr_repo.era_domain_ids = ehr_repo.get_available_era_domain_ids()
+        logger.info(f"reading {', '.join(ehr_repo.era_domain_ids) or 'no'} domains from era tables")
+        if (orm):
+            logger.warning("--eras is ignored by the ORM loader")
     crit_repo = CritRepo(crit_conn_str)
 
-    ehr = ehr_repo.get_ehr()
+    prefetched_ehr = None
+    if (all_trials):
+        if (ctx.invoked_subcommand is not None):
+            criteria_by_trial_ids = crit_repo.get_criteria_by_trial_ids(crit_repo.get_all_trial_ids())
+        else:
+            criteria_by_trial_ids = []
+    elif (async_fetch):
+        fetch_ehr = not pushdown and not chunk_size and not cache_dir and not ehr_repo.era_domain_ids and ctx.invoked_subcommand is None
+        criteria_by_trial_ids, prefetched_ehr = asyncio.run(fetch_criteria_and_ehr(crit_conn_str, ehr_conn_str, list(trial_ids), fetch_ehr, orm))
+    else:
+        criteria_by_trial_ids = []
+        for trial_id in trial_ids:
+            criteria_by_trial_id = {
+                'trial_id': trial_id,
+                'criteria': crit_repo.get_criteria_by_trial_id(trial_id)
+            }
+            criteria_by_trial_ids.append(criteria_by_trial_id)
+
+    if (descendants):
+        if (cache_dir):
+            ehr_repo.concept_closure = ehr_repo.get_cached_concept_closure(cache_dir)
+        elif (all_trials):
+            ehr_repo.concept_closure = ehr_repo.get_concept_closure()
+        else:
+            presence_concept_ids = {criterion.concept_id for criteria_by_trial_id in criteria_by_trial_ids for criterion in criteria_by_trial_id['criteria'] if is_presence_criterion(criterion)}
+            ehr_repo.concept_closure = ehr_repo.get_concept_closure(presence_concept_ids)
+        logger.info(f"expanding criteria with {ehr_repo.concept_closure}")
+        if (orm):
+            logger.warning("--descendants is ignored by the ORM loader")
+    if (index_date):
+        ehr_repo.temporal_window = ehr_repo.get_temporal_window(index_date.date(), lookback_days, observation_period)
+        logger.info(f"evaluating criteria in {ehr_repo.temporal_window}")
+        if (orm or pushdown):
+            logger.warning("--index-date is ignored by the ORM loader and --pushdown")
+    elif (lookback_days):
+        logger.warning("--lookback is ignored without --index-date")
+    if (orm and lab_value_policy != DEFAULT_LAB_VALUE_POLICY):
+        logger.warning(f"the ORM loader always uses the {DEFAULT_LAB_VALUE_POLICY} lab value policy")
 
-    criteria_by_trial_ids = []
-    for trial_id in trial_ids:
-        criteria_by_trial_id = {
-            'trial_id': trial_id,
-            'criteria': crit_repo.get_criteria_by_trial_id(trial_id)
+    # --all-trials scores criteria that are not known yet, and a prefetched EHR is already complete
+    concept_filter = None
+    if (selective_load and not all_trials and prefetched_ehr is None):
+        concept_filter = ehr_repo.get_concept_filter([criterion for criteria_by_trial_id in criteria_by_trial_ids for criterion in criteria_by_trial_id['criteria']])
+        logger.info(f"loading only {sum(map(len, concept_filter.values()))} concepts referenced by the criteria")
+
+    if (ctx.invoked_subcommand is not None):
+        ctx.obj = {
+            'ehr_repo': ehr_repo,
+            'criteria_by_trial_ids': criteria_by_trial_ids,
+            'orm': orm,
+            'pushdown': pushdown,
+            'cache_dir': cache_dir,
+            'concept_filter': concept_filter,
+            'weight_backend': weight_backend,
+            'weight_cache': weight_cache,
         }
-        criteria_by_trial_ids.append(criteria_by_trial_id)
+        return
+
+    if (sample_fraction and not all_trials):
+        if (orm or pushdown or chunk_size or workers > 1 or compare_weights or impact or index_date):
+            logger.warning("--sample-fraction scores a sampled snapshot, --orm, --pushdown, --chunk-size, --workers, --compare-weights, --impact and --index-date are ignored")
+        gist_scores = get_sampled_gist_scores(criteria_by_trial_ids, ehr_repo, sample_fraction, target_width, confidence, sample_seed, weight_backend=weight_backend, weight_cache=weight_cache, concept_filter=concept_filter)
+        logger.info(gist_scores)
+        logger.info(f"weight cache: {weight_cache.get_report()}")
+        return
+    if (sample_fraction):
+        logger.warning("--sample-fraction is not supported with --all-trials")
+
+    result_store = None
+    if (result_store_conn_str):
+        # the EHR fingerprint covers the person and domain tables only, concept_ancestor changes the descendants matched
+        concept_closure_version = ehr_repo.get_concept_closure_fingerprint() if descendants and not orm else None
+        result_store = ResultStore(result_store_conn_str, ehr_repo.get_ehr_fingerprint(), get_settings_hash(weight_backend, lab_value_policy, descendants, orm, bool(chunk_size), ehr_repo.temporal_window, ehr_repo.era_domain_ids, concept_closure_version))
+
+    # the EHR is loaded on first use, so runs served from the result store never load it
+    get_ehr = functools.lru_cache(maxsize=None)(lambda: None if pushdown or chunk_size else load_ehr(ehr_repo, orm, cache_dir, prefetched_ehr, concept_filter))
+
+    if (compare_weights and not pushdown and not chunk_size):
+        ehr = get_ehr()
+        weight_backends = {name: get_weight_backend('subsample', sample_size=weight_sample_size) if name == 'subsample' else get_weight_backend(name) for name in WEIGHT_BACKENDS}
+        for criteria_by_trial_id in criteria_by_trial_ids:
+            lab_stats = get_lab_stats(get_lab_criteria(criteria_by_trial_id['criteria']), ehr)
+            features, labels = get_features_and_labels(lab_stats, ehr)
+            for row in compare_weight_backends(features, labels, weight_backends):
+                logger.info(f"weights of {criteria_by_trial_id['trial_id']}: {row}")
+
+    if (all_trials):
+        if (compare_weights or impact):
+            logger.warning("--compare-weights and --impact are not supported with --all-trials")
+        score_all_trials(crit_repo, ehr_repo, get_ehr, result_store, batch_size, checkpoint_path, pushdown, chunk_size, workers, weight_backend, weight_cache)
+        logger.info(f"weight cache: {weight_cache.get_report()}")
+        return
+
+    gist_scores = score_stored_trials(criteria_by_trial_ids, result_store, ehr_repo, get_ehr, pushdown, chunk_size, workers, weight_backend, weight_cache, concept_filter)
+    logger.info(gist_scores)
+
+    if (impact and chunk_size):
+        logger.warning("--impact is not supported with --chunk-size")
+    elif (impact):
+        ehr = get_ehr()
+        for criteria_by_trial_id in criteria_by_trial_ids:
+            if (pushdown):
+                ehr = ehr_repo.get_ehr_elig_flags(criteria_by_trial_id['criteria'])
+            criterion_impacts = get_criterion_impacts(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr, weight_backend, weight_cache)
+            for criterion_impact in criterion_impacts['impacts']:
+                logger.info(f"leaving out {criterion_impact['concept_id']} changes m_gist_score of {criterion_impacts['trial_id']} by {criterion_impact['impact']:+.6f} to {criterion_impact['m_gist_score']:.6f}")
+    logger.info(f"weight cache: {weight_cache.get_report()}")
+
 
+def report_profile(profile_output, prometheus_textfile):
+    report = profiling.profiler.get_report()
+    logger.info(f"profile: {json.dumps(report)}")
+    if (profile_output):
+        write_json_report(report, profile_output)
+    if (prometheus_textfile):
+        write_prometheus_textfile(report, prometheus_textfile)
+    disable_profiling()
+
+
+def score_trials(criteria_by_trial_ids, ehr_repo, ehr, pushdown, chunk_size, workers, weight_backend, weight_cache, concept_filter=None):
+    if (pushdown or chunk_size):
+        gist_scores = []
+        for criteria_by_trial_id in criteria_by_trial_ids:
+            if (chunk_size):
+                gist_score = get_streamed_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], lambda: map(ehr_repo.apply_temporal_window, ehr_repo.iter_ehr_snapshots(chunk_size, concept_filter)), weight_backend)
+            else:
+                ehr = ehr_repo.get_ehr_elig_flags(criteria_by_trial_id['criteria'])
+                logger.info(f"fetched eligibility flags for {len(ehr)} persons")
+                gist_score = get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr, weight_backend, weight_cache)
+            gist_scores.append(gist_score)
+    elif (workers > 1):
+        gist_scores = get_pooled_gist_scores(criteria_by_trial_ids, ehr, workers, weight_backend, weight_cache)
+    else:
+        gist_scores = get_gist_scores(criteria_by_trial_ids, ehr, weight_backend, weight_cache)
+    return gist_scores
+
+
+def score_stored_trials(criteria_by_trial_ids, result_store, ehr_repo, get_ehr, *args, score=score_trials):
+    if (result_store is None):
+        return score(criteria_by_trial_ids, ehr_repo, get_ehr(), *args)
+    stored_scores = result_store.get_scores(criteria_by_trial_ids)
+    changed = [criteria_by_trial_id for criteria_by_trial_id in criteria_by_trial_ids if criteria_by_trial_id['trial_id'] not in stored_scores]
+    if (changed):
+        gist_scores = score(changed, ehr_repo, get_ehr(), *args)
+        result_store.put_scores(changed, gist_scores)
+        stored_scores.update((gist_score['trial_id'], gist_score) for gist_score in gist_scores)
+    return [stored_scores[criteria_by_trial_id['trial_id']] for criteria_by_trial_id in criteria_by_trial_ids]
+
+
+def score_trials_or_errors(criteria_by_trial_ids, *args):
+    try:
+        return score_trials(criteria_by_trial_ids, *args)
+    except Exception:
+        logger.exception(f"failed to score a batch of {len(criteria_by_trial_ids)} trials, scoring them one by one")
     gist_scores = []
     for criteria_by_trial_id in criteria_by_trial_ids:
-        gist_score = get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr)
-        gist_scores.append(gist_score)
-    logger.info(gist_scores)
+        try:
+            gist_scores.extend(score_trials([criteria_by_trial_id], *args))
+        except Exception as e:
+            logger.error(f"failed to score trial {criteria_by_trial_id['trial_id']}: {e}")
+            gist_scores.append({'trial_id': criteria_by_trial_id['trial_id'], 'error': f"{type(e).__name__}: {e}"})
+    return gist_scores
+
+
+def score_all_trials(crit_repo, ehr_repo, get_ehr, result_store, batch_size, checkpoint_path, *args):
+    checkpoint = ScoreCheckpoint(checkpoint_path) if checkpoint_path else None
+    num_scored = 0
+    for batch in get_batches((trial_id for trial_id in crit_repo.iter_all_trial_ids() if checkpoint is None or trial_id not in checkpoint), batch_size):
+        criteria_by_trial_ids = crit_repo.get_criteria_by_trial_ids(batch)
+        gist_scores = score_stored_trials(criteria_by_trial_ids, result_store, ehr_repo, get_ehr, *args, score=score_trials_or_errors)
+        if (checkpoint is not None):
+            checkpoint.write_batch(gist_scores)
+        else:
+            logger.info(gist_scores)
+        num_scored += len(gist_scores)
+        logger.info(f"scored {num_scored} trials, last {batch[-1]}")
+    if (checkpoint is not None):
+        logger.info(f"checkpoint {checkpoint_path} has {len(checkpoint)} scored trials and {checkpoint.num_errors} failed trials")
+
+
+def get_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if (len(batch) == batch_size):
+            yield batch
+            batch = []
+    if (batch):
+        yield batch
+
+
+@cli.command()
+@click.option('--steps', type=int, default=50, help="Number of lab eligibility ranges per Measurement/age criterion")
+@click.option('--spread', type=float, default=0.5, help="Ranges are scaled about their center from 1 - spread to 1 + spread times their width")
+@click.pass_obj
+def sweep(obj, steps, spread):
+    """Sweep the lab eligibility ranges of each trial and report s-GIST and m-GIST curves."""
+
+    ehr_repo = obj['ehr_repo']
+    if (obj['orm']):
+        logger.warning("sweep reads lab values from a snapshot, --orm is ignored")
+    if (not obj['pushdown']):
+        ehr = load_ehr(ehr_repo, False, obj['cache_dir'], concept_filter=obj['concept_filter'])
+    for criteria_by_trial_id in obj['criteria_by_trial_ids']:
+        if (obj['pushdown']):
+            ehr = ehr_repo.get_ehr_elig_flags(criteria_by_trial_id['criteria'])
+        scorer = get_incremental_scorer(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr, obj['weight_backend'], obj['weight_cache'])
+        for lab_range_curve in get_lab_range_curves(scorer, ehr, steps, spread):
+            logger.info(f"lab range curve of {criteria_by_trial_id['trial_id']}: {lab_range_curve}")
+
+
+@cli.command('verify-eras')
+@click.pass_obj
+def verify_eras(obj):
+    """Report the persons whose Condition or Drug criteria are met in only one of the occurrence and era tables."""
+
+    ehr_repo = obj['ehr_repo']
+    era_domain_ids = ehr_repo.era_domain_ids or ehr_repo.get_available_era_domain_ids()
+    if (not era_domain_ids):
+        raise click.ClickException("condition_era and drug_era have no rows to verify")
+    ehr_repo.era_domain_ids = ()
+    occurrence_ehr = load_ehr(ehr_repo, False, obj['cache_dir'], concept_filter=obj['concept_filter'])
+    ehr_repo.era_domain_ids = era_domain_ids
+    era_ehr = load_ehr(ehr_repo, False, obj['cache_dir'], concept_filter=obj['concept_filter'])
+    for difference in get_era_differences(obj['criteria_by_trial_ids'], occurrence_ehr, era_ehr, era_domain_ids):
+        logger.warning(f"{difference['domain_id']} {difference['concept_id']} of {difference['trial_id']} is met by {len(difference['occurrence_only'])} persons only in the occurrence table and {len(difference['era_only'])} only in the era table: {difference}")
+
+
+def load_ehr(ehr_repo, orm, cache_dir, prefetched_ehr=None, concept_filter=None):
+    if (prefetched_ehr is not None):
+        ehr = prefetched_ehr if orm else ehr_repo.configure_snapshot(prefetched_ehr)
+    elif (orm):
+        ehr = ehr_repo.get_ehr(concept_filter)
+    elif (cache_dir):
+        ehr = ehr_repo.get_cached_ehr_snapshot(cache_dir, concept_filter)
+    else:
+        ehr = ehr_repo.get_ehr_snapshot(concept_filter)
+    if (not orm):
+        ehr = ehr_repo.apply_temporal_window(ehr)
+    logger.info(f"loaded {len(ehr)} persons from the EHR")
+    return ehr
+
 
 if __name__ == '__main__':
     cli(auto_envvar_prefix='GIST')
\ No newline at end of file
@@ -2,9 +2,10 @@ import datetime
 import logging
 import numpy as np
 import math
-from sklearn import svm
-from sklearn import preprocessing
-from functools import reduce
+from gist.snapshot import EhrSnapshot
+from gist.labs import get_person_lab_value
+from gist.weights import get_weights
+from gist.profiling import profiled, add_count
 
 logger = logging.getLogger(__name__)
 
@@ -12,40 +13,129 @@ AGE_CONCEPT_ID = 4265453
 GENDER_CONCEPT_ID = 4135376
 MALE_GENDER_CONCEPT_ID = 8507
 FEMALE_GENDER_CONCEPT_ID = 8532
+PRESENCE_DOMAIN_IDS = ("Condition", "Drug", "Procedure", "Observation")
 
-def get_gist_score(trial_id, criteria, ehr):
-    lab_criteria = list(filter(lambda criterion: criterion.domain_id == "Measurement" or criterion.concept_id == AGE_CONCEPT_ID, criteria))
+
+def is_presence_criterion(criterion):
+    return criterion.concept_id not in (GENDER_CONCEPT_ID, AGE_CONCEPT_ID) and criterion.domain_id in PRESENCE_DOMAIN_IDS
+
+
+def is_measurement_criterion(criterion):
+    return criterion.concept_id not in (GENDER_CONCEPT_ID, AGE_CONCEPT_ID) and criterion.domain_id not in PRESENCE_DOMAIN_IDS
+
+
+@profiled
+def get_gist_score(trial_id, criteria, ehr, weight_backend=None, weight_cache=None):
+    lab_criteria = get_lab_criteria(criteria)
 
     lab_stats = get_lab_stats(lab_criteria, ehr)
     logger.info(f"calculated {len(lab_stats)} lab stats")
 
-    features, labels = get_features_and_labels(lab_stats, ehr)
-    weights = get_weights(features, labels)
+    weights = get_signature_weights(get_lab_signature(criteria), lab_stats, ehr, weight_backend, weight_cache)
     logger.info(f"calculated {len(weights)} weights")
 
-    elig_checks = get_elig_checks(criteria, ehr)
-    logger.info(f"checked eligibility for {len(elig_checks)} EHRs")
+    elig_matrix = get_elig_matrix(criteria, ehr)
+    logger.info(f"checked eligibility for {len(elig_matrix)} EHRs")
+
+    return assemble_gist_score(trial_id, criteria, elig_matrix, weights)
+
+
+@profiled
+def get_gist_scores(criteria_by_trial_ids, ehr, weight_backend=None, weight_cache=None):
+    unique_criteria = {}
+    for criteria_by_trial_id in criteria_by_trial_ids:
+        for criterion in criteria_by_trial_id['criteria']:
+            unique_criteria.setdefault(get_criterion_key(criterion), criterion)
+    num_criteria = sum(len(criteria_by_trial_id['criteria']) for criteria_by_trial_id in criteria_by_trial_ids)
+    add_count('trials', len(criteria_by_trial_ids))
+    add_count('criteria', len(unique_criteria))
+    logger.info(f"deduplicated {num_criteria} criteria of {len(criteria_by_trial_ids)} trials to {len(unique_criteria)}")
+
+    columns = {key: column for column, key in enumerate(unique_criteria)}
+    elig_matrix = get_elig_matrix(list(unique_criteria.values()), ehr)
+    logger.info(f"checked eligibility for {len(elig_matrix)} EHRs")
+
+    unique_lab_criteria = get_lab_criteria(unique_criteria.values())
+    lab_stats_by_key = {get_criterion_key(lab_criterion): get_lab_stats([lab_criterion], ehr)[lab_criterion.concept_id] for lab_criterion in unique_lab_criteria}
+    logger.info(f"calculated {len(lab_stats_by_key)} lab stats")
+
+    weights_by_signature = {}
+    gist_scores = []
+    for criteria_by_trial_id in criteria_by_trial_ids:
+        criteria = criteria_by_trial_id['criteria']
+        signature = get_lab_signature(criteria)
+        if (signature not in weights_by_signature):
+            lab_stats = {lab_stats_by_key[key]['criterion'].concept_id: lab_stats_by_key[key] for key in signature}
+            weights_by_signature[signature] = get_signature_weights(signature, lab_stats, ehr, weight_backend, weight_cache)
+        weights = weights_by_signature[signature]
+
+        trial_elig_matrix = elig_matrix[:, [columns[get_criterion_key(criterion)] for criterion in criteria]]
+        gist_scores.append(assemble_gist_score(criteria_by_trial_id['trial_id'], criteria, trial_elig_matrix, weights))
+    logger.info(f"got weights for {len(weights_by_signature)} lab signatures of {len(criteria_by_trial_ids)} trials")
+    return gist_scores
+
+
+@profiled
+def get_signature_weights(lab_signature, lab_stats, ehr, weight_backend=None, weight_cache=None):
+    if (weight_cache is not None):
+        ehr_version = getattr(ehr, 'version', None)
+        key = weight_cache.get_key(lab_signature, (ehr_version, getattr(ehr, 'lab_value_policy', None)), weight_backend)
+        weights = weight_cache.get(key, persistent=ehr_version is not None)
+        if (weights is not None):
+            logger.debug(f"weight cache hit for {lab_signature}")
+            return weights
 
+    features, labels = get_features_and_labels(lab_stats, ehr)
+    weights = get_weights(features, labels, weight_backend)
+    if (weight_cache is not None):
+        weight_cache.put(key, weights, persistent=ehr_version is not None)
+    return weights
+
+
+@profiled
+def assemble_gist_score(trial_id, criteria, elig_matrix, weights):
     gist_score = {
         'trial_id': trial_id
     }
-    gist_score['s_gist_scores'] = get_s_gist_scores(criteria, elig_checks, weights)
+    gist_score['s_gist_scores'] = get_s_gist_scores(criteria, elig_matrix, weights)
 
     if (any(s_gist_score['score'] == 0 for s_gist_score in gist_score['s_gist_scores'])):
         zero_s_gist_scores = list(filter(lambda s_gist_score: s_gist_score['score'] == 0, gist_score['s_gist_scores']))
         logger.info(f"found {len(zero_s_gist_scores)} s_gist_score(s) with a score of zero")
         zero_concept_ids = list(map(lambda s_gist_score: s_gist_score['concept_id'], zero_s_gist_scores))
         logger.info(f"removing {zero_concept_ids} from analysis")
-        new_criteria = list(filter(lambda criterion: criterion.concept_id not in zero_concept_ids, criteria))
+        kept_columns = [criterion.concept_id not in zero_concept_ids for criterion in criteria]
 
-        new_elig_checks = get_elig_checks(new_criteria, ehr)
-        gist_score['m_gist_score'] = get_m_gist_score(new_elig_checks, weights)
+        gist_score['m_gist_score'] = get_m_gist_score(elig_matrix[:, kept_columns], weights)
     else:
         logger.info("no zeros in s gist scores found")
-        gist_score['m_gist_score'] = get_m_gist_score(elig_checks, weights)
+        gist_score['m_gist_score'] = get_m_gist_score(elig_matrix, weights)
     return gist_score
 
+
+def get_lab_criteria(criteria):
+    return list(filter(lambda criterion: criterion.domain_id == "Measurement" or criterion.concept_id == AGE_CONCEPT_ID, criteria))
+
+
+def get_criterion_key(criterion):
+    return (criterion.concept_id, criterion.domain_id, criterion.cat_elig, criterion.lab_elig_min, criterion.lab_elig_max)
+
+
+def get_lab_signature(criteria):
+    return tuple(sorted(set(map(get_criterion_key, get_lab_criteria(criteria))), key=repr))
+
+
+def get_standardized_mean(lab_stat):
+    # a lab without values or with a single distinct value has no spread to standardize by
+    if (lab_stat['std_dev'] == 0):
+        return 0.0
+    return lab_stat['mean'] / lab_stat['std_dev']
+
+
+@profiled
 def get_lab_stats(lab_criteria, ehr):
+    add_count('criteria', len(lab_criteria))
+    add_count('persons', len(ehr))
     lab_stats = {}
     for lab_criterion in lab_criteria:
         lab_stats[lab_criterion.concept_id] = {
@@ -53,22 +143,38 @@ def get_lab_stats(lab_criteria, ehr):
         }
         values = []
 
-        if (lab_criterion.concept_id == AGE_CONCEPT_ID):
+        if (isinstance(ehr, EhrSnapshot)):
+            values = ehr.ages() if lab_criterion.concept_id == AGE_CONCEPT_ID else ehr.lab_values(lab_criterion.concept_id)
+            values = values[~np.isnan(values)].tolist()
+        elif (lab_criterion.concept_id == AGE_CONCEPT_ID):
             values = list(map(lambda person: datetime.date.today().year - person.year_of_birth, ehr))
         else:
-            measurements_by_criterion = list(map(lambda person: reduce(lambda m1, m2: m1 if m1.measurement_concept_id == lab_criterion.concept_id else m2, person.measurement), ehr))
-            values = list(map(lambda measurement: measurement.value_as_number, measurements_by_criterion))
-
-        lab_stats[lab_criterion.concept_id]['mean'] = float(sum(values) / len(values))
-        lab_stats[lab_criterion.concept_id]['inelig_prec'] = float(len(list(filter(lambda value: lab_criterion.lab_elig_min >= value or value >= lab_criterion.lab_elig_max, values))) / len(values))
-        square_diff = list(map(lambda value: pow(float(value) - lab_stats[lab_criterion.concept_id]['mean'], 2), values))
-        lab_stats[lab_criterion.concept_id]['std_dev'] = float(math.sqrt(sum(square_diff) / len(square_diff)))
-        lab_stats[lab_criterion.concept_id]['norm_min'] = float(lab_criterion.lab_elig_min - lab_stats[lab_criterion.concept_id]['mean'] / lab_stats[lab_criterion.concept_id]['std_dev'])
-        lab_stats[lab_criterion.concept_id]['norm_max'] = float(lab_criterion.lab_elig_max - lab_stats[lab_criterion.concept_id]['mean'] / lab_stats[lab_criterion.concept_id]['std_dev'])
+            values = list(map(lambda person: get_person_lab_value(person, lab_criterion.concept_id), ehr))
+            values = list(filter(lambda value: value is not None, values))
+
+        if (len(values) == 0):
+            # windowing, sampling or selective loading can leave a lab without any values, its features fall back to their defaults
+            logger.warning(f"no values for lab {lab_criterion.concept_id}, using empty lab stats")
+            lab_stats[lab_criterion.concept_id]['mean'] = 0.0
+            lab_stats[lab_criterion.concept_id]['inelig_prec'] = 0.0
+            lab_stats[lab_criterion.concept_id]['std_dev'] = 0.0
+        else:
+            lab_stats[lab_criterion.concept_id]['mean'] = float(sum(values) / len(values))
+            lab_stats[lab_criterion.concept_id]['inelig_prec'] = float(len(list(filter(lambda value: lab_criterion.lab_elig_min >= value or value >= lab_criterion.lab_elig_max, values))) / len(values))
+            square_diff = list(map(lambda value: pow(float(value) - lab_stats[lab_criterion.concept_id]['mean'], 2), values))
+            lab_stats[lab_criterion.concept_id]['std_dev'] = float(math.sqrt(sum(square_diff) / len(square_diff)))
+        standardized_mean = get_standardized_mean(lab_stats[lab_criterion.concept_id])
+        lab_stats[lab_criterion.concept_id]['norm_min'] = float(lab_criterion.lab_elig_min - standardized_mean)
+        lab_stats[lab_criterion.concept_id]['norm_max'] = float(lab_criterion.lab_elig_max - standardized_mean)
     return lab_stats
 
 
+@profiled
 def get_features_and_labels(lab_stats, ehr):
+    add_count('persons', len(ehr))
+    if (isinstance(ehr, EhrSnapshot)):
+        return get_snapshot_features_and_labels(lab_stats, ehr)
+
     features = []
     labels = []
     for person in ehr:
@@ -76,40 +182,39 @@ def get_features_and_labels(lab_stats, ehr):
         for lab_concept_id, lab_stat in lab_stats.items():
             if (lab_concept_id == AGE_CONCEPT_ID):
                 age = datetime.date.today().year - person.year_of_birth
-                weighed_age = age - lab_stat['mean'] / lab_stat['std_dev'] * lab_stat['inelig_prec']
+                weighed_age = age - get_standardized_mean(lab_stat) * lab_stat['inelig_prec']
                 labels.append(weighed_age)
             else:
-                exists = any(measurement.measurement_concept_id == lab_concept_id for measurement in person.measurement)
-                if (exists):
-                    value = float(reduce(lambda m1, m2: m1 if m1.measurement_concept_id == lab_concept_id else m2, person.measurement).value_as_number)
+                value = get_person_lab_value(person, lab_concept_id)
+                if (value is not None):
                     try:
                         weighted_value = (value - lab_stat['mean']) / (lab_stat['std_dev'] * lab_stat['inelig_prec'])
                         feature.append(weighted_value)
                     except ZeroDivisionError:
                         feature.append(0)
                 else:
-                    default_value = float((lab_stat['criterion']['lab_elig_max'] - lab_stat['criterion']['lab_elig_min']) / 2 * lab_stat['criterion']['lab_elig_min'])
-                    weighted_value = default_value - lab_stat['mean'] / lab_stat['std_dev'] * lab_stat['inelig_prec']
+                    default_value = float((lab_stat['criterion'].lab_elig_max - lab_stat['criterion'].lab_elig_min) / 2 * lab_stat['criterion'].lab_elig_min)
+                    weighted_value = default_value - get_standardized_mean(lab_stat) * lab_stat['inelig_prec']
                     feature.append(weighted_value)
         features.append(feature)
     return (features, labels)
 
 
-def get_weights(features, labels):
-    features = np.array(features)
-    labels = np.array(labels)
-
-    lab_enc = preprocessing.LabelEncoder()
-    encoded_labels = lab_enc.fit_transform(labels)
-    clf = svm.SVC(gamma='auto')
-    clf.fit(features, encoded_labels)
-
-    predictions = clf.predict(features)
-    predictions_recovered = lab_enc.inverse_transform(predictions)
-    result = list(predictions_recovered)
-
-    weights = list(map(lambda tuple: 1 / (1 + abs(tuple[0] - tuple[1])), zip(result, labels)))
-    return weights
+def get_snapshot_features_and_labels(lab_stats, ehr):
+    feature_columns = []
+    labels = np.array([])
+    for lab_concept_id, lab_stat in lab_stats.items():
+        if (lab_concept_id == AGE_CONCEPT_ID):
+            labels = ehr.ages() - get_standardized_mean(lab_stat) * lab_stat['inelig_prec']
+        else:
+            values = ehr.lab_values(lab_concept_id)
+            denominator = lab_stat['std_dev'] * lab_stat['inelig_prec']
+            weighted_values = (values - lab_stat['mean']) / denominator if denominator != 0 else np.zeros(len(values))
+            default_value = float((lab_stat['criterion'].lab_elig_max - lab_stat['criterion'].lab_elig_min) / 2 * lab_stat['criterion'].lab_elig_min)
+            weighted_default = default_value - get_standardized_mean(lab_stat) * lab_stat['inelig_prec']
+            feature_columns.append(np.where(np.isnan(values), weighted_default, weighted_values))
+    features = np.column_stack(feature_columns) if feature_columns else np.empty((len(ehr), 0))
+    return (features, labels)
 
 
 def check_categorical_value(criterion, value):
@@ -120,7 +225,11 @@ def check_categorical_value(criterion, value):
     return False
 
 
+@profiled
 def get_elig_checks(criteria, ehr):
+    if (isinstance(ehr, EhrSnapshot)):
+        return get_snapshot_elig_checks(criteria, ehr)
+
     elig_checks = []
     for person in ehr:
         elig_check = {
@@ -150,41 +259,100 @@ def get_elig_checks(criteria, ehr):
                     elig_check['checks'][criterion.concept_id]['is_eligible'] = any(condition.condition_concept_id == criterion.concept_id for condition in person.condition_occurrence)
                 elif (criterion.domain_id == "Drug"):
                     elig_check['checks'][criterion.concept_id]['is_eligible'] = any(drug.drug_concept_id == criterion.concept_id for drug in person.drug_exposure)
-                elif (criterion.domain_id == "Obseration"):
+                elif (criterion.domain_id == "Observation"):
                     elig_check['checks'][criterion.concept_id]['is_eligible'] = any(observation.observation_concept_id == criterion.concept_id for observation in person.observation)
                 elif (criterion.domain_id == "Procedure"):
                     elig_check['checks'][criterion.concept_id]['is_eligible'] = any(procedure.procedure_concept_id == criterion.concept_id for procedure in person.procedure_occurrence)
                 else:
                     elig_check['checks'][criterion.concept_id]['is_eligible'] = False
             else:
-                value = reduce(lambda m1, m2: m1 if m1.measurement_concept_id == criterion.concept_id else m2, person.measurement).value_as_number
-                elig_check['checks'][criterion.concept_id]['is_eligible'] = check_categorical_value(criterion, value)
+                value = get_person_lab_value(person, criterion.concept_id)
+                elig_check['checks'][criterion.concept_id]['is_eligible'] = value is not None and check_categorical_value(criterion, value)
         elig_checks.append(elig_check)
     return elig_checks
 
 
-def get_s_gist_scores(criteria, elig_checks, weights):
-    s_gist_scores = []
-    sum_weights = sum(weights)
-    for criterion in criteria:
-        s_gist_score = get_s_gist_score(criterion, elig_checks, weights, sum_weights)
-        s_gist_scores.append(s_gist_score)
-    return s_gist_scores
+def check_categorical_values(criterion, values):
+    in_range = (criterion.lab_elig_min <= values) & (values <= criterion.lab_elig_max)
+    out_of_range = (criterion.lab_elig_min > values) | (values > criterion.lab_elig_max)
+    if (criterion.cat_elig == 1):
+        return in_range
+    elif (criterion.cat_elig == 0):
+        return out_of_range
+    return np.zeros(len(values), dtype=bool)
 
 
+def get_snapshot_elig_mask(criterion, ehr):
+    if (criterion.concept_id == GENDER_CONCEPT_ID):
+        if (criterion.cat_elig == 0):
+            return np.ones(len(ehr), dtype=bool)
+        elif (criterion.cat_elig == 1):
+            return ehr.gender_source_concept_ids == MALE_GENDER_CONCEPT_ID
+        elif (criterion.cat_elig == 2):
+            return ehr.gender_source_concept_ids == FEMALE_GENDER_CONCEPT_ID
+        return np.zeros(len(ehr), dtype=bool)
+    elif (criterion.concept_id == AGE_CONCEPT_ID):
+        return check_categorical_values(criterion, ehr.ages())
+    elif (is_presence_criterion(criterion)):
+        return ehr.has_concept(criterion.domain_id, criterion.concept_id)
+    return check_categorical_values(criterion, ehr.lab_values(criterion.concept_id))
 
-def get_s_gist_score(criterion, elig_checks, weights, sum_weights):
-    s_gist_score = {
-        'concept_id': criterion.concept_id
-    }
-    checks = list(map(lambda elig_check: int(elig_check['checks'][criterion.concept_id]['is_eligible']), elig_checks))
-    weight_checks = list(map(lambda tuple: tuple[0] * tuple[1], zip(checks, weights)))
-    s_gist_score['score'] = sum(weight_checks) / sum_weights
-    return s_gist_score
+
+def get_snapshot_elig_checks(criteria, ehr):
+    elig_matrix = get_elig_matrix(criteria, ehr)
+    elig_checks = []
+    for index, person_id in enumerate(ehr.person_ids.tolist()):
+        elig_check = {
+            'person_id': person_id,
+            'checks': {}
+        }
+        for column, criterion in enumerate(criteria):
+            elig_check['checks'][criterion.concept_id] = {
+                'criterion': criterion,
+                'is_eligible': bool(elig_matrix[index, column])
+            }
+        elig_checks.append(elig_check)
+    return elig_checks
+
+
+@profiled
+def get_elig_matrix(criteria, ehr):
+    add_count('criteria', len(criteria))
+    add_count('persons', len(ehr))
+    if (isinstance(ehr, EhrSnapshot)):
+        columns = [get_snapshot_elig_mask(criterion, ehr) for criterion in criteria]
+    else:
+        # elig checks are keyed by concept_id, so criteria sharing one are checked in separate passes
+        passes = []
+        for criterion in criteria:
+            remaining = [criteria_pass for criteria_pass in passes if all(other.concept_id != criterion.concept_id for other in criteria_pass)]
+            if (remaining):
+                remaining[0].append(criterion)
+            else:
+                passes.append([criterion])
+        columns_by_criterion = {}
+        for criteria_pass in passes:
+            elig_checks = get_elig_checks(criteria_pass, ehr)
+            for criterion in criteria_pass:
+                columns_by_criterion[id(criterion)] = [elig_check['checks'][criterion.concept_id]['is_eligible'] for elig_check in elig_checks]
+        columns = [columns_by_criterion[id(criterion)] for criterion in criteria]
+    if (not columns):
+        return np.ones((len(ehr), 0), dtype=bool)
+    return np.column_stack(columns).astype(bool, copy=False)
+
+
+def get_s_gist_scores(criteria, elig_matrix, weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    scores = weights @ elig_matrix / weights.sum()
+    return [{'concept_id': criterion.concept_id, 'score': float(score)} for criterion, score in zip(criteria, scores)]
+
+
+def get_num_fully_eligible(elig_matrix):
+    return int(np.count_nonzero(elig_matrix.all(axis=1)))
 
 
-def get_m_gist_score(elig_checks, weights):
-    num_fully_eligible = len(list(filter(lambda elig_check: all(map(lambda check: check['is_eligible'], elig_check['checks'].values())), elig_checks)))
+def get_m_gist_score(elig_matrix, weights):
+    num_fully_eligible = get_num_fully_eligible(elig_matrix)
     logger.debug(f'Number of Fully Eligible People: {num_fully_eligible}')
-    score = num_fully_eligible / sum(weights)
-    return score
\ No newline at end of file
+    score = num_fully_eligible / float(np.sum(weights))
+    return score
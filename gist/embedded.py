@@ -0,0 +1,66 @@
+import glob
+import logging
+import os
+from sqlalchemy import create_engine, event
+from gist.entities import CritBase, EhrBase
+
+logger = logging.getLogger(__name__)
+
+EXTRACT_SCHEME = 'extract'
+
+# file name suffix and DuckDB table function of each supported extract format
+EXTRACT_FORMATS = (
+    ('.parquet', 'read_parquet'),
+    ('.csv', 'read_csv_auto'),
+    ('.csv.gz', 'read_csv_auto'),
+)
+
+
+def is_extract_conn_str(conn_str):
+    return conn_str.startswith(f"{EXTRACT_SCHEME}://")
+
+
+def get_extract_dir(conn_str):
+    return conn_str[len(f"{EXTRACT_SCHEME}://"):]
+
+
+def get_extract_views(extract_dir):
+    table_names = sorted(set(CritBase.metadata.tables) | set(EhrBase.metadata.tables))
+    views = {}
+    for table_name in table_names:
+        for suffix, reader in EXTRACT_FORMATS:
+            path = os.path.join(extract_dir, f"{table_name}{suffix}")
+            partitions = os.path.join(extract_dir, table_name, f"*{suffix}")
+            if (os.path.isfile(path)):
+                views[table_name] = f"{reader}('{path.replace(chr(39), chr(39) * 2)}')"
+                break
+            if (os.path.isdir(os.path.join(extract_dir, table_name)) and glob.glob(partitions)):
+                views[table_name] = f"{reader}('{partitions.replace(chr(39), chr(39) * 2)}')"
+                break
+    return views
+
+
+def create_extract_engine(extract_dir):
+    try:
+        import duckdb_engine  # noqa: F401
+    except ImportError:
+        raise ImportError("reading OMOP extract files needs the duckdb and duckdb-engine packages") from None
+    views = get_extract_views(extract_dir)
+    if (not views):
+        raise ValueError(f"no OMOP table files (.parquet, .csv or .csv.gz) found in {extract_dir}")
+    logger.info(f"reading {len(views)} tables from {extract_dir}: {', '.join(views)}")
+
+    engine = create_engine('duckdb:///:memory:')
+
+    @event.listens_for(engine, 'connect')
+    def create_views(dbapi_connection, connection_record):
+        for table_name, source in views.items():
+            dbapi_connection.execute(f"CREATE VIEW {table_name} AS SELECT * FROM {source}")
+
+    return engine
+
+
+def create_repo_engine(conn_str):
+    if (is_extract_conn_str(conn_str)):
+        return create_extract_engine(get_extract_dir(conn_str))
+    return create_engine(conn_str)
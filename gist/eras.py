@@ -0,0 +1,28 @@
+import logging
+from gist.core import is_presence_criterion
+
+logger = logging.getLogger(__name__)
+
+
+def get_era_differences(criteria_by_trial_ids, occurrence_ehr, era_ehr, era_domain_ids):
+    """Persons whose presence criteria are met in only one of two snapshots of the same persons, read from the occurrence and from the era tables."""
+    masks = {}
+    differences = []
+    for criteria_by_trial_id in criteria_by_trial_ids:
+        for criterion in criteria_by_trial_id['criteria']:
+            if (not is_presence_criterion(criterion) or criterion.domain_id not in era_domain_ids):
+                continue
+            key = (criterion.domain_id, criterion.concept_id)
+            if (key not in masks):
+                masks[key] = (occurrence_ehr.has_concept(*key), era_ehr.has_concept(*key))
+            occurrence_mask, era_mask = masks[key]
+            if ((occurrence_mask != era_mask).any()):
+                differences.append({
+                    'trial_id': criteria_by_trial_id['trial_id'],
+                    'domain_id': criterion.domain_id,
+                    'concept_id': criterion.concept_id,
+                    'occurrence_only': occurrence_ehr.person_ids[occurrence_mask & ~era_mask].tolist(),
+                    'era_only': era_ehr.person_ids[era_mask & ~occurrence_mask].tolist(),
+                })
+    logger.info(f"compared {len(masks)} condition and drug concepts, {len(differences)} criteria differ")
+    return differences
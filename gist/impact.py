@@ -0,0 +1,122 @@
+import logging
+import numpy as np
+from gist.core import get_elig_matrix, get_lab_criteria, get_lab_stats, get_lab_signature, get_signature_weights, get_s_gist_scores
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalGistScorer:
+    """Eligibility matrix and weights of one trial, re-scored as criteria are removed or added.
+
+    Every person keeps a count of the counted criteria it fails, where counted criteria are the
+    active ones left once zero s-GIST criteria are dropped by concept_id. A person is fully eligible
+    when the count is zero, so removing or adding a criterion is one pass over its column. The
+    weights are kept as trained for the original criteria.
+    """
+
+    def __init__(self, trial_id, criteria, elig_matrix, weights):
+        self.trial_id = trial_id
+        self.criteria = list(criteria)
+        self.columns = [np.asarray(elig_matrix[:, column], dtype=bool) for column in range(len(self.criteria))]
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.sum_weights = float(self.weights.sum())
+        self.scores = [s_gist_score['score'] for s_gist_score in get_s_gist_scores(self.criteria, elig_matrix, self.weights)]
+        self.active = [True] * len(self.criteria)
+        self.counted = [False] * len(self.criteria)
+        self.failure_counts = np.zeros(len(self.weights), dtype=np.int32)
+        self.update_counted()
+
+    def __len__(self):
+        return len(self.criteria)
+
+    def get_counted(self):
+        zero_concept_ids = {criterion.concept_id for criterion, score, active in zip(self.criteria, self.scores, self.active) if active and score == 0}
+        return [active and criterion.concept_id not in zero_concept_ids for criterion, active in zip(self.criteria, self.active)]
+
+    def update_counted(self):
+        for index, counted in enumerate(self.get_counted()):
+            if (counted and not self.counted[index]):
+                self.failure_counts += ~self.columns[index]
+            elif (not counted and self.counted[index]):
+                self.failure_counts -= ~self.columns[index]
+            self.counted[index] = counted
+
+    def remove_criterion(self, index):
+        self.active[index] = False
+        self.update_counted()
+
+    def restore_criterion(self, index):
+        self.active[index] = True
+        self.update_counted()
+
+    def add_criterion(self, criterion, elig_column):
+        elig_column = np.asarray(elig_column, dtype=bool)
+        self.criteria.append(criterion)
+        self.columns.append(elig_column)
+        self.scores.append(float(self.weights @ elig_column / self.sum_weights))
+        self.active.append(True)
+        self.counted.append(False)
+        self.update_counted()
+        return len(self.criteria) - 1
+
+    def get_num_fully_eligible(self):
+        return int(np.count_nonzero(self.failure_counts == 0))
+
+    def get_m_gist_score(self):
+        return self.get_num_fully_eligible() / self.sum_weights
+
+    def get_s_gist_scores(self):
+        return [{'concept_id': criterion.concept_id, 'score': score} for criterion, score, active in zip(self.criteria, self.scores, self.active) if active]
+
+    def get_gist_score(self):
+        return {
+            'trial_id': self.trial_id,
+            's_gist_scores': self.get_s_gist_scores(),
+            'm_gist_score': self.get_m_gist_score(),
+        }
+
+    def get_leave_one_out_scores(self):
+        num_fully_eligible = self.get_num_fully_eligible()
+        counted_indices = [index for index, counted in enumerate(self.counted) if counted]
+        single_failures = np.flatnonzero(self.failure_counts == 1)
+        num_only_failing = np.zeros(len(self.criteria), dtype=np.int64)
+        if (counted_indices and len(single_failures)):
+            failures = ~np.column_stack([self.columns[index][single_failures] for index in counted_indices])
+            num_only_failing[counted_indices] = np.bincount(failures.argmax(axis=1), minlength=len(counted_indices))
+
+        m_gist_score = num_fully_eligible / self.sum_weights
+        leave_one_out_scores = []
+        for index, criterion in enumerate(self.criteria):
+            if (not self.active[index]):
+                continue
+            if (self.counted[index]):
+                score = (num_fully_eligible + int(num_only_failing[index])) / self.sum_weights
+            else:
+                # removing a dropped criterion only matters when it un-drops another one with its concept_id
+                self.remove_criterion(index)
+                score = self.get_m_gist_score()
+                self.restore_criterion(index)
+            leave_one_out_scores.append({
+                'concept_id': criterion.concept_id,
+                'm_gist_score': score,
+                'impact': score - m_gist_score,
+            })
+        return leave_one_out_scores
+
+
+def get_incremental_scorer(trial_id, criteria, ehr, weight_backend=None, weight_cache=None):
+    lab_stats = get_lab_stats(get_lab_criteria(criteria), ehr)
+    weights = get_signature_weights(get_lab_signature(criteria), lab_stats, ehr, weight_backend, weight_cache)
+    elig_matrix = get_elig_matrix(criteria, ehr)
+    logger.info(f"checked eligibility for {len(elig_matrix)} EHRs")
+    return IncrementalGistScorer(trial_id, criteria, elig_matrix, weights)
+
+
+def get_criterion_impacts(trial_id, criteria, ehr, weight_backend=None, weight_cache=None):
+    scorer = get_incremental_scorer(trial_id, criteria, ehr, weight_backend, weight_cache)
+    impacts = sorted(scorer.get_leave_one_out_scores(), key=lambda impact: impact['impact'], reverse=True)
+    return {
+        'trial_id': trial_id,
+        'm_gist_score': scorer.get_m_gist_score(),
+        'impacts': impacts,
+    }
@@ -0,0 +1,100 @@
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_ARRAYS = ('concept_ids', 'offsets', 'person_indices')
+
+
+class ConceptPostings:
+    """Sorted person indices of every concept_id in one domain: persons of concept_ids[i] are person_indices[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self, concept_ids, offsets, person_indices):
+        self.concept_ids = concept_ids
+        self.offsets = offsets
+        self.person_indices = person_indices
+
+    def get_person_indices(self, concept_id):
+        position = np.searchsorted(self.concept_ids, concept_id)
+        if (position == len(self.concept_ids) or self.concept_ids[position] != concept_id):
+            return self.person_indices[0:0]
+        return self.person_indices[self.offsets[position]:self.offsets[position + 1]]
+
+
+class ConceptIndex:
+    """Inverted index from (domain_id, concept_id) to the persons having at least one row with it."""
+
+    def __init__(self, num_persons, postings):
+        self.num_persons = num_persons
+        self.postings = postings
+
+    def __repr__(self):
+        concepts = ', '.join(f"{domain_id}={len(postings.concept_ids)}" for domain_id, postings in self.postings.items())
+        return f"ConceptIndex(persons={self.num_persons}, {concepts})"
+
+    def get_person_indices(self, domain_id, concept_id):
+        return self.postings[domain_id].get_person_indices(concept_id)
+
+    def get_mask(self, domain_id, concept_id):
+        mask = np.zeros(self.num_persons, dtype=bool)
+        mask[self.get_person_indices(domain_id, concept_id)] = True
+        return mask
+
+    def get_union_mask(self, domain_id, concept_ids):
+        mask = np.zeros(self.num_persons, dtype=bool)
+        for concept_id in concept_ids:
+            mask[self.get_person_indices(domain_id, concept_id)] = True
+        return mask
+
+
+def build_concept_postings(rows):
+    person_index = rows.person_index
+    order = np.lexsort((person_index, rows.concept_ids))
+    concept_ids = rows.concept_ids[order]
+    person_index = person_index[order]
+    is_new_pair = np.ones(len(order), dtype=bool)
+    is_new_pair[1:] = (concept_ids[1:] != concept_ids[:-1]) | (person_index[1:] != person_index[:-1])
+    concept_ids = concept_ids[is_new_pair]
+    person_index = person_index[is_new_pair]
+
+    unique_concept_ids, counts = np.unique(concept_ids, return_counts=True)
+    offsets = np.zeros(len(unique_concept_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return ConceptPostings(unique_concept_ids, offsets, person_index.astype(np.int64))
+
+
+def merge_concept_postings(postings, delta_postings):
+    concept_ids = np.concatenate((np.repeat(postings.concept_ids, np.diff(postings.offsets)), np.repeat(delta_postings.concept_ids, np.diff(delta_postings.offsets))))
+    person_index = np.concatenate((postings.person_indices, delta_postings.person_indices))
+    order = np.lexsort((person_index, concept_ids))
+    concept_ids = concept_ids[order]
+    person_index = person_index[order]
+    is_new_pair = np.ones(len(order), dtype=bool)
+    is_new_pair[1:] = (concept_ids[1:] != concept_ids[:-1]) | (person_index[1:] != person_index[:-1])
+    concept_ids = concept_ids[is_new_pair]
+
+    unique_concept_ids, counts = np.unique(concept_ids, return_counts=True)
+    offsets = np.zeros(len(unique_concept_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return ConceptPostings(unique_concept_ids, offsets, person_index[is_new_pair].astype(np.int64))
+
+
+def build_concept_index(snapshot):
+    postings = {domain_id: build_concept_postings(rows) for domain_id, rows in snapshot.domains.items()}
+    concept_index = ConceptIndex(len(snapshot), postings)
+    logger.debug(f"built {concept_index}")
+    return concept_index
+
+
+def save_concept_index(concept_index, path):
+    for domain_id, postings in concept_index.postings.items():
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(path, f"index.{domain_id}.{name}.npy"), getattr(postings, name))
+
+
+def load_concept_index(path, num_persons, domain_ids, mmap_mode='r'):
+    postings = {}
+    for domain_id in domain_ids:
+        postings[domain_id] = ConceptPostings(*[np.load(os.path.join(path, f"index.{domain_id}.{name}.npy"), mmap_mode=mmap_mode) for name in INDEX_ARRAYS])
+    return ConceptIndex(num_persons, postings)
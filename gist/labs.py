@@ -0,0 +1,87 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LAB_VALUE_POLICIES = ('latest', 'earliest', 'mean', 'min', 'max')
+DEFAULT_LAB_VALUE_POLICY = 'latest'
+
+
+class LabTable:
+    """One value per (measurement_concept_id, person) under a policy: values of concept_ids[i] are at person_indices/values[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self, num_persons, policy, concept_ids, offsets, person_indices, values):
+        self.num_persons = num_persons
+        self.policy = policy
+        self.concept_ids = concept_ids
+        self.offsets = offsets
+        self.person_indices = person_indices
+        self.values = values
+
+    def __repr__(self):
+        return f"LabTable(policy={self.policy}, concepts={len(self.concept_ids)}, values={len(self.values)})"
+
+    def get_values(self, concept_id):
+        values = np.full(self.num_persons, np.nan)
+        position = np.searchsorted(self.concept_ids, concept_id)
+        if (position < len(self.concept_ids) and self.concept_ids[position] == concept_id):
+            start, end = self.offsets[position], self.offsets[position + 1]
+            values[self.person_indices[start:end]] = self.values[start:end]
+        return values
+
+
+def build_lab_table(rows, policy=DEFAULT_LAB_VALUE_POLICY):
+    if (policy not in LAB_VALUE_POLICIES):
+        raise ValueError(f"unknown lab value policy {policy}, expected one of {LAB_VALUE_POLICIES}")
+    has_value = ~np.isnan(rows.values)
+    person_index = rows.person_index[has_value]
+    concept_ids = rows.concept_ids[has_value]
+    values = rows.values[has_value]
+    dates = rows.dates[has_value]
+
+    order = np.lexsort((dates, person_index, concept_ids))
+    person_index = person_index[order]
+    concept_ids = concept_ids[order]
+    values = values[order]
+
+    is_group_start = np.ones(len(order), dtype=bool)
+    is_group_start[1:] = (concept_ids[1:] != concept_ids[:-1]) | (person_index[1:] != person_index[:-1])
+    starts = np.flatnonzero(is_group_start)
+    ends = np.append(starts[1:], len(order))
+    if (len(starts) == 0):
+        group_values = values[0:0]
+    elif (policy == 'latest'):
+        group_values = values[ends - 1]
+    elif (policy == 'earliest'):
+        group_values = values[starts]
+    elif (policy == 'mean'):
+        group_values = np.add.reduceat(values, starts) / (ends - starts)
+    elif (policy == 'min'):
+        group_values = np.minimum.reduceat(values, starts)
+    else:
+        group_values = np.maximum.reduceat(values, starts)
+
+    unique_concept_ids, counts = np.unique(concept_ids[starts], return_counts=True)
+    offsets = np.zeros(len(unique_concept_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    lab_table = LabTable(rows.num_persons, policy, unique_concept_ids, offsets, person_index[starts], group_values)
+    logger.debug(f"built {lab_table}")
+    return lab_table
+
+
+def get_person_lab_value(person, concept_id, policy=DEFAULT_LAB_VALUE_POLICY):
+    measurements = [measurement for measurement in person.measurement if measurement.measurement_concept_id == concept_id and measurement.value_as_number is not None]
+    if (not measurements):
+        return None
+    values = [float(measurement.value_as_number) for measurement in sorted(measurements, key=lambda measurement: (measurement.measurement_date, measurement.measurement_id))]
+    if (policy == 'latest'):
+        return values[-1]
+    elif (policy == 'earliest'):
+        return values[0]
+    elif (policy == 'mean'):
+        return sum(values) / len(values)
+    elif (policy == 'min'):
+        return min(values)
+    elif (policy == 'max'):
+        return max(values)
+    raise ValueError(f"unknown lab value policy {policy}, expected one of {LAB_VALUE_POLICIES}")
@@ -0,0 +1,86 @@
+import logging
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from gist.core import get_gist_score, get_gist_scores
+from gist.snapshot import load_snapshot
+
+logger = logging.getLogger(__name__)
+
+# EHR of the current worker process, set by init_worker or inherited on fork
+worker_ehr = None
+# weight cache of the current worker process, built once by init_worker so it is shared by all its tasks
+worker_weight_cache = None
+
+
+def init_worker(weight_cache=None, ehr=None, snapshot_path=None, concept_closure=None, lab_value_policy=None):
+    global worker_ehr, worker_weight_cache
+    worker_weight_cache = weight_cache
+    if (snapshot_path is not None):
+        worker_ehr = load_snapshot(snapshot_path)
+        worker_ehr.concept_closure = concept_closure
+        worker_ehr.lab_value_policy = lab_value_policy
+    elif (ehr is not None):
+        worker_ehr = ehr
+
+
+def score_trial(trial_id, criteria, weight_backend=None, weight_cache=None):
+    try:
+        return get_gist_score(trial_id, criteria, worker_ehr, weight_backend, weight_cache)
+    except Exception as e:
+        logger.exception(f"failed to score trial {trial_id}")
+        return {'trial_id': trial_id, 'error': f"{type(e).__name__}: {e}"}
+
+
+def score_chunk(criteria_by_trial_ids, weight_backend=None):
+    # returns the weight cache hits and misses of the chunk too, which the parent adds up for its report
+    hits, misses = (worker_weight_cache.hits, worker_weight_cache.misses) if worker_weight_cache is not None else (0, 0)
+    gist_scores = score_trials(criteria_by_trial_ids, weight_backend, worker_weight_cache)
+    if (worker_weight_cache is not None):
+        hits, misses = worker_weight_cache.hits - hits, worker_weight_cache.misses - misses
+    return (gist_scores, hits, misses)
+
+
+def score_trials(criteria_by_trial_ids, weight_backend=None, weight_cache=None):
+    # the trials of a chunk share their eligibility columns, lab stats and weights as in sequential scoring
+    try:
+        return get_gist_scores(criteria_by_trial_ids, worker_ehr, weight_backend, weight_cache)
+    except Exception:
+        logger.exception(f"failed to score a chunk of {len(criteria_by_trial_ids)} trials, scoring them one by one")
+    return [score_trial(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], weight_backend, weight_cache) for criteria_by_trial_id in criteria_by_trial_ids]
+
+
+def get_pooled_gist_scores(criteria_by_trial_ids, ehr, workers, weight_backend=None, weight_cache=None):
+    global worker_ehr
+    snapshot_path = getattr(ehr, 'path', None)
+    if (snapshot_path is not None):
+        logger.info(f"sharing memory-mapped snapshot {snapshot_path} with {workers} workers")
+        mp_context = None
+        initargs = (weight_cache, None, snapshot_path, ehr.concept_closure, ehr.lab_value_policy)
+    elif ('fork' in multiprocessing.get_all_start_methods()):
+        logger.info(f"sharing the EHR with {workers} forked workers")
+        worker_ehr = ehr
+        mp_context = multiprocessing.get_context('fork')
+        initargs = (weight_cache,)
+    else:
+        logger.info(f"copying the EHR once to each of {workers} workers")
+        mp_context = None
+        initargs = (weight_cache, ehr)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=init_worker, initargs=initargs) as executor:
+        chunk_size = max(math.ceil(len(criteria_by_trial_ids) / workers), 1)
+        chunks = [criteria_by_trial_ids[start:start + chunk_size] for start in range(0, len(criteria_by_trial_ids), chunk_size)]
+        futures = [executor.submit(score_chunk, chunk, weight_backend) for chunk in chunks]
+        gist_scores = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunk_gist_scores, hits, misses = future.result()
+                gist_scores.extend(chunk_gist_scores)
+                if (weight_cache is not None):
+                    weight_cache.hits += hits
+                    weight_cache.misses += misses
+            except Exception as e:
+                logger.error(f"worker scoring a chunk of {len(chunk)} trials failed: {e}")
+                gist_scores.extend({'trial_id': criteria_by_trial_id['trial_id'], 'error': f"{type(e).__name__}: {e}"} for criteria_by_trial_id in chunk)
+    worker_ehr = None
+    return gist_scores
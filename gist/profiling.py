@@ -0,0 +1,166 @@
+import functools
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Profiler of the current process, None unless enable_profiling was called
+profiler = None
+
+
+class StageStats:
+    """Totals of every call to one instrumented stage."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_traced_bytes = 0
+        self.max_rss_bytes = 0
+        self.counts = {}
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'peak_traced_bytes': self.peak_traced_bytes,
+            'max_rss_bytes': self.max_rss_bytes,
+            'counts': self.counts,
+        }
+
+
+def reset_traced_peak():
+    # tracemalloc.reset_peak is new in Python 3.9, before that restarting tracing is the only way to reset the peak
+    if (hasattr(tracemalloc, 'reset_peak')):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+class Profiler:
+    """Wall time, CPU time, memory peaks and counts per stage, kept on a stack so nested stages are attributed correctly."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.stack = []
+        self.start = time.perf_counter()
+        if (trace_memory and not tracemalloc.is_tracing()):
+            tracemalloc.start()
+
+    def enter(self, stage):
+        if (self.trace_memory):
+            if (self.stack):
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+            reset_traced_peak()
+        self.stack.append({'stage': stage, 'wall': time.perf_counter(), 'cpu': time.process_time(), 'peak': 0, 'counts': {}})
+
+    def exit(self):
+        frame = self.stack.pop()
+        stats = self.stages.setdefault(frame['stage'], StageStats())
+        stats.calls += 1
+        stats.wall_seconds += time.perf_counter() - frame['wall']
+        stats.cpu_seconds += time.process_time() - frame['cpu']
+        if (self.trace_memory):
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            stats.peak_traced_bytes = max(stats.peak_traced_bytes, peak)
+            if (self.stack):
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        stats.max_rss_bytes = max(stats.max_rss_bytes, get_max_rss_bytes())
+        for name, value in frame['counts'].items():
+            stats.counts[name] = stats.counts.get(name, 0) + value
+
+    def add_count(self, name, value):
+        if (self.stack):
+            counts = self.stack[-1]['counts']
+            counts[name] = counts.get(name, 0) + value
+
+    def get_report(self):
+        return {
+            'wall_seconds': time.perf_counter() - self.start,
+            'max_rss_bytes': get_max_rss_bytes(),
+            'stages': {stage: stats.to_dict() for stage, stats in self.stages.items()},
+        }
+
+
+def get_max_rss_bytes():
+    if (resource is None):
+        return 0
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def enable_profiling(trace_memory=True):
+    global profiler
+    profiler = Profiler(trace_memory)
+    return profiler
+
+
+def disable_profiling():
+    global profiler
+    if (profiler is not None and profiler.trace_memory):
+        tracemalloc.stop()
+    profiler = None
+
+
+def profiled(func):
+    stage = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if (profiler is None):
+            return func(*args, **kwargs)
+        profiler.enter(stage)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.exit()
+    return wrapper
+
+
+def add_count(name, value):
+    if (profiler is not None):
+        profiler.add_count(name, value)
+
+
+def write_json_report(report, path):
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    logger.info(f"wrote profile to {path}")
+
+
+def write_prometheus_textfile(report, path):
+    lines = [
+        '# HELP gist_run_wall_seconds Wall time of the whole run.',
+        '# TYPE gist_run_wall_seconds gauge',
+        f"gist_run_wall_seconds {report['wall_seconds']}",
+        '# HELP gist_run_max_rss_bytes Peak resident set size of the run.',
+        '# TYPE gist_run_max_rss_bytes gauge',
+        f"gist_run_max_rss_bytes {report['max_rss_bytes']}",
+    ]
+    for metric, help_text in (('calls', 'Calls of a stage.'), ('wall_seconds', 'Wall time spent in a stage.'), ('cpu_seconds', 'CPU time spent in a stage.'), ('peak_traced_bytes', 'Peak memory traced by tracemalloc during a stage.'), ('max_rss_bytes', 'Peak resident set size at the end of a stage.')):
+        lines.append(f"# HELP gist_stage_{metric} {help_text}")
+        lines.append(f"# TYPE gist_stage_{metric} gauge")
+        for stage, stats in report['stages'].items():
+            lines.append(f"gist_stage_{metric}{{stage=\"{stage}\"}} {stats[metric]}")
+    lines.append('# HELP gist_stage_count Rows, persons and criteria processed by a stage.')
+    lines.append('# TYPE gist_stage_count gauge')
+    for stage, stats in report['stages'].items():
+        for name, value in stats['counts'].items():
+            lines.append(f"gist_stage_count{{stage=\"{stage}\",name=\"{name}\"}} {value}")
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+    logger.info(f"wrote prometheus metrics to {path}")
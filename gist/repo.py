@@ -1,27 +1,67 @@
+import hashlib
 import logging
-from sqlalchemy import create_engine, select, func, funcfilter
-from sqlalchemy.orm import sessionmaker, lazyload, joinedload, subqueryload
-from gist.entities import EligibilityCriterion, Person, ConditionOccurrence, DrugExposure, Measurement, Observation, ProcedureOccurrence
+import os
+import shutil
+import numpy as np
+from sqlalchemy import select, func, funcfilter, or_, false, true
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, lazyload, joinedload, subqueryload, load_only
+from gist.entities import EligibilityCriterion, Person, ConditionOccurrence, DrugExposure, Measurement, Observation, ProcedureOccurrence, ConceptAncestor, ObservationPeriod, ConditionEra, DrugEra
+from gist.core import is_presence_criterion, is_measurement_criterion
+from gist.labs import DEFAULT_LAB_VALUE_POLICY
+from gist.embedded import create_repo_engine
+from gist.temporal import TemporalWindow
+from gist.vocab import build_concept_closure, save_concept_closure, load_concept_closure
+from gist.profiling import profiled, add_count
+from gist.snapshot import SNAPSHOT_FORMAT_VERSION, PushdownSnapshot, build_snapshot, save_snapshot, load_snapshot, find_snapshot, to_int_array, to_float_array, to_date_array
+
+FETCH_PARTITION_SIZE = 100000
+AGE_BAND_YEARS = 10
+# multiplier of the integer hash that orders persons within a stratum
+SAMPLE_HASH_MULTIPLIER = 2654435761
+SAMPLE_HASH_MODULUS = 4294967296
+
+# (primary key, person_id, concept_id, value, date) columns read per clinical domain
+DOMAIN_COLUMNS = {
+    'Condition': (ConditionOccurrence.condition_occurrence_id, ConditionOccurrence.person_id, ConditionOccurrence.condition_concept_id, None, ConditionOccurrence.condition_start_date),
+    'Drug': (DrugExposure.drug_exposure_id, DrugExposure.person_id, DrugExposure.drug_concept_id, None, DrugExposure.drug_exposure_start_date),
+    'Procedure': (ProcedureOccurrence.procedure_occurrence_id, ProcedureOccurrence.person_id, ProcedureOccurrence.procedure_concept_id, None, ProcedureOccurrence.procedure_date),
+    'Observation': (Observation.observation_id, Observation.person_id, Observation.observation_concept_id, Observation.value_as_number, Observation.observation_date),
+    'Measurement': (Measurement.measurement_id, Measurement.person_id, Measurement.measurement_concept_id, Measurement.value_as_number, Measurement.measurement_date),
+}
+
+# era tables that can stand in for the rows of a domain, dated by the era start
+ERA_DOMAIN_COLUMNS = {
+    'Condition': (ConditionEra.condition_era_id, ConditionEra.person_id, ConditionEra.condition_concept_id, None, ConditionEra.condition_era_start_date),
+    'Drug': (DrugEra.drug_era_id, DrugEra.person_id, DrugEra.drug_concept_id, None, DrugEra.drug_era_start_date),
+}
 
 class Repo:
 
     def __init__(self, conn_str):
         self.conn_str = conn_str
-        self.engine = create_engine(self.conn_str)
+        self.engine = create_repo_engine(self.conn_str)
         self.session = sessionmaker(self.engine)
 
 
 class CritRepo(Repo):
 
     def get_all_trial_ids(self):
+        return list(self.iter_all_trial_ids())
+
+    def iter_all_trial_ids(self):
         stmt = (
             select(EligibilityCriterion.nct_id)
+            .distinct()
+            .order_by(EligibilityCriterion.nct_id)
         )
-        logging.debug(f"query for get_all_trial_ids: {stmt}")
-        with self.session() as session:
-            trial_ids = session.execute(stmt).scalars().unique()
-        return trial_ids
+        logging.debug(f"query for iter_all_trial_ids: {stmt}")
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(stmt)
+            for partition in result.scalars().partitions(FETCH_PARTITION_SIZE):
+                yield from partition
 
+    @profiled
     def get_criteria_by_trial_id(self, trial_id):
         stmt = (
             select(EligibilityCriterion)
@@ -32,19 +72,381 @@ class CritRepo(Repo):
             trials = session.execute(stmt).scalars().all()
         return trials
 
+    @profiled
+    def get_criteria_by_trial_ids(self, trial_ids):
+        stmt = (
+            select(EligibilityCriterion)
+            .filter(EligibilityCriterion.nct_id.in_(list(trial_ids)))
+        )
+        logging.debug(f"query for get_criteria_by_trial_ids: {stmt}")
+        with self.session() as session:
+            criteria = session.execute(stmt).scalars().all()
+        criteria_by_trial_id = {trial_id: [] for trial_id in trial_ids}
+        for criterion in criteria:
+            criteria_by_trial_id[criterion.nct_id].append(criterion)
+        return [{'trial_id': trial_id, 'criteria': trial_criteria} for trial_id, trial_criteria in criteria_by_trial_id.items()]
+
 
 class EhrRepo(Repo):
 
-    def get_ehr(self):
-        stmt = (
-            select(Person)
-            .options(subqueryload(Person.condition_occurrence))
-            .options(subqueryload(Person.drug_exposure))
-            .options(subqueryload(Person.procedure_occurrence))
-            .options(subqueryload(Person.observation))
-            .options(subqueryload(Person.measurement))
-        )
+    def __init__(self, conn_str):
+        super().__init__(conn_str)
+        self.concept_closure = None
+        self.lab_value_policy = DEFAULT_LAB_VALUE_POLICY
+        self.temporal_window = None
+        self.era_domain_ids = ()
+
+    def get_domain_columns(self):
+        return {domain_id: ERA_DOMAIN_COLUMNS[domain_id] if domain_id in self.era_domain_ids else columns for domain_id, columns in DOMAIN_COLUMNS.items()}
+
+    def get_available_era_domain_ids(self):
+        era_domain_ids = []
+        for domain_id, (pk, *_) in ERA_DOMAIN_COLUMNS.items():
+            try:
+                with self.engine.connect() as conn:
+                    has_rows = conn.execute(select(pk).limit(1)).first() is not None
+            except DBAPIError:
+                has_rows = False
+            if (has_rows):
+                era_domain_ids.append(domain_id)
+            else:
+                logging.warning(f"{pk.table.name} is missing or empty, {domain_id} criteria use {DOMAIN_COLUMNS[domain_id][0].table.name}")
+        return tuple(era_domain_ids)
+
+    def get_concept_filter(self, criteria):
+        concept_filter = {domain_id: set() for domain_id in DOMAIN_COLUMNS}
+        for criterion in criteria:
+            if (is_presence_criterion(criterion)):
+                concept_filter[criterion.domain_id].update(self._get_descendant_ids(criterion.concept_id))
+            elif (is_measurement_criterion(criterion)):
+                concept_filter['Measurement'].add(criterion.concept_id)
+        return {domain_id: sorted(concept_ids) for domain_id, concept_ids in concept_filter.items()}
+
+    @profiled
+    def get_ehr(self, concept_filter=None):
+        if (concept_filter is None):
+            stmt = (
+                select(Person)
+                .options(subqueryload(Person.condition_occurrence))
+                .options(subqueryload(Person.drug_exposure))
+                .options(subqueryload(Person.procedure_occurrence))
+                .options(subqueryload(Person.observation))
+                .options(subqueryload(Person.measurement))
+            )
+        else:
+            stmt = select(Person).options(load_only(Person.person_id, Person.year_of_birth, Person.gender_source_concept_id))
+            for domain_id, relationship in (('Condition', Person.condition_occurrence), ('Drug', Person.drug_exposure), ('Procedure', Person.procedure_occurrence), ('Observation', Person.observation), ('Measurement', Person.measurement)):
+                pk, person_id, concept_id, value, date = DOMAIN_COLUMNS[domain_id]
+                columns = [pk, person_id, concept_id, date] if value is None else [pk, person_id, concept_id, date, value]
+                stmt = stmt.options(subqueryload(relationship.and_(concept_id.in_(concept_filter[domain_id]))).load_only(*columns))
         logging.debug(f"query for get_ehr: {stmt}")
         with self.session() as session:
             ehr = session.execute(stmt).scalars().unique().all()
+        add_count('persons', len(ehr))
         return ehr
+
+    @profiled
+    def get_ehr_snapshot(self, concept_filter=None, watermarks=None):
+        # rows are read up to the watermarks, so a later refresh picks up exactly the rows appended after them
+        watermarks = watermarks or self.get_ehr_watermarks()
+        with self.engine.connect() as conn:
+            person_columns = self._fetch_person_columns(conn, watermarks)
+            domain_columns = self._fetch_domain_columns(conn, concept_filter=concept_filter, watermarks=watermarks)
+        snapshot = build_snapshot(person_columns, domain_columns)
+        snapshot.watermarks = watermarks
+        snapshot.source = self.get_ehr_source(concept_filter)
+        return self.configure_snapshot(snapshot)
+
+    @profiled
+    def refresh_ehr_snapshot(self, snapshot, concept_filter=None, watermarks=None):
+        watermarks = watermarks or self.get_ehr_watermarks()
+        if (snapshot.watermarks is None or snapshot.source != self.get_ehr_source(concept_filter)):
+            logging.info("snapshot has no watermarks of this EHR, rebuilding it")
+            return self.get_ehr_snapshot(concept_filter, watermarks)
+        if (snapshot.watermarks == watermarks):
+            return snapshot
+        with self.engine.connect() as conn:
+            for pk in self._get_watermark_pks():
+                num_rows, max_id = snapshot.watermarks[pk.table.name]
+                stmt = select(func.count()).filter(*self._get_watermark_filters(pk, watermarks, snapshot.watermarks))
+                num_appended = conn.execute(stmt).scalar()
+                if (num_rows + num_appended != watermarks[pk.table.name][0]):
+                    # rows were deleted or inserted below the watermark, which only a rebuild picks up
+                    logging.info(f"{pk.table.name} changed below its watermark {max_id}, rebuilding the snapshot")
+                    return self.get_ehr_snapshot(concept_filter, watermarks)
+            person_columns = self._fetch_person_columns(conn, watermarks, snapshot.watermarks)
+            domain_columns = self._fetch_domain_columns(conn, concept_filter=concept_filter, watermarks=watermarks, after_watermarks=snapshot.watermarks)
+        snapshot.append(person_columns, domain_columns)
+        snapshot.watermarks = watermarks
+        return self.configure_snapshot(snapshot)
+
+    def get_ehr_source(self, concept_filter=None):
+        return self._get_source_hash(concept_filter).hexdigest()
+
+    def _get_source_hash(self, concept_filter=None):
+        source = hashlib.sha256(f"{SNAPSHOT_FORMAT_VERSION}|{self.conn_str}".encode())
+        if (concept_filter is not None):
+            source.update(f"|{sorted(concept_filter.items())}".encode())
+        if (self.era_domain_ids):
+            source.update(f"|eras:{sorted(self.era_domain_ids)}".encode())
+        return source
+
+    def get_ehr_watermarks(self):
+        watermarks = {}
+        with self.engine.connect() as conn:
+            for pk in self._get_watermark_pks():
+                stmt = select(func.count(), func.max(pk))
+                logging.debug(f"query for get_ehr_watermarks: {stmt}")
+                watermarks[pk.table.name] = tuple(conn.execute(stmt).one())
+        return watermarks
+
+    @profiled
+    def get_ehr_fingerprint(self, concept_filter=None, watermarks=None):
+        fingerprint = self._get_source_hash(concept_filter)
+        for table_name, (num_rows, max_id) in (watermarks or self.get_ehr_watermarks()).items():
+            fingerprint.update(f"|{table_name}:{num_rows}:{max_id}".encode())
+        return fingerprint.hexdigest()
+
+    @profiled
+    def get_cached_ehr_snapshot(self, cache_dir, concept_filter=None):
+        watermarks = self.get_ehr_watermarks()
+        fingerprint = self.get_ehr_fingerprint(concept_filter, watermarks)
+        path = os.path.join(cache_dir, fingerprint)
+        if (os.path.exists(os.path.join(path, 'meta.json'))):
+            logging.info(f"ehr snapshot cache hit for {fingerprint}")
+            return self.configure_snapshot(load_snapshot(path))
+        previous_path = find_snapshot(cache_dir, self.get_ehr_source(concept_filter))
+        if (previous_path is not None):
+            logging.info(f"ehr snapshot cache miss for {fingerprint}, refreshing {previous_path}")
+            snapshot = self.refresh_ehr_snapshot(load_snapshot(previous_path), concept_filter, watermarks)
+        else:
+            logging.info(f"ehr snapshot cache miss for {fingerprint}")
+            snapshot = self.get_ehr_snapshot(concept_filter, watermarks)
+        snapshot.version = fingerprint
+        save_snapshot(snapshot, path)
+        if (previous_path is not None):
+            shutil.rmtree(previous_path)
+        return self.configure_snapshot(load_snapshot(path))
+
+    def iter_ehr_snapshots(self, chunk_size, concept_filter=None):
+        stmt = (
+            select(Person.person_id, Person.year_of_birth, Person.gender_source_concept_id)
+            .order_by(Person.person_id)
+        )
+        logging.debug(f"query for iter_ehr_snapshots: {stmt}")
+        with self.engine.connect() as person_conn, self.engine.connect() as domain_conn:
+            result = person_conn.execution_options(stream_results=True).execute(stmt)
+            for partition in result.partitions(chunk_size):
+                person_ids, year_of_birth, gender_source_concept_ids = zip(*partition)
+                person_columns = (to_int_array(person_ids), to_int_array(year_of_birth), to_int_array(gender_source_concept_ids))
+                domain_columns = self._fetch_domain_columns(domain_conn, person_ids[0], person_ids[-1], concept_filter)
+                yield self.configure_snapshot(build_snapshot(person_columns, domain_columns))
+
+    @profiled
+    def get_ehr_sample_snapshot(self, sample_fraction, seed=0, min_stratum_size=2, concept_filter=None):
+        # strata are birth year bands by gender, the first persons of each stratum in hash order are sampled
+        band = Person.year_of_birth - Person.year_of_birth % AGE_BAND_YEARS
+        stratum = (band, Person.gender_source_concept_id)
+        sample_hash = (Person.person_id + seed) * SAMPLE_HASH_MULTIPLIER % SAMPLE_HASH_MODULUS
+        ranked = (
+            select(
+                Person.person_id, Person.year_of_birth, Person.gender_source_concept_id, band.label('band'),
+                func.row_number().over(partition_by=stratum, order_by=(sample_hash, Person.person_id)).label('stratum_rank'),
+                func.count().over(partition_by=stratum).label('stratum_size'),
+            )
+            .subquery()
+        )
+        sample_filter = or_(ranked.c.stratum_rank <= ranked.c.stratum_size * sample_fraction, ranked.c.stratum_rank <= min_stratum_size)
+        stmt = (
+            select(ranked.c.person_id, ranked.c.year_of_birth, ranked.c.gender_source_concept_id, ranked.c.band, ranked.c.stratum_size)
+            .filter(sample_filter)
+            .order_by(ranked.c.person_id)
+        )
+        logging.debug(f"query for sampled persons: {stmt}")
+        with self.engine.connect() as conn:
+            person_ids, year_of_birth, gender_source_concept_ids, bands, stratum_sizes = self._fetch_columns(conn, stmt, 5)
+            person_columns = (to_int_array(person_ids), to_int_array(year_of_birth), to_int_array(gender_source_concept_ids))
+            add_count('persons', len(person_ids))
+            sampled_person_ids = select(ranked.c.person_id).filter(sample_filter)
+            domain_columns = self._fetch_domain_columns(conn, concept_filter=concept_filter, sampled_person_ids=sampled_person_ids)
+        snapshot = self.configure_snapshot(build_snapshot(person_columns, domain_columns))
+        strata = {}
+        stratum_ids = np.fromiter((strata.setdefault(key, len(strata)) for key in zip(bands, gender_source_concept_ids)), dtype=np.int64, count=len(person_ids))
+        population_sizes = np.zeros(len(strata), dtype=np.int64)
+        population_sizes[stratum_ids] = stratum_sizes
+        logging.info(f"sampled {len(snapshot)} of {population_sizes.sum()} persons from {len(strata)} strata")
+        return (snapshot, stratum_ids, population_sizes)
+
+    def _fetch_person_columns(self, conn, watermarks, after_watermarks=None):
+        stmt = (
+            select(Person.person_id, Person.year_of_birth, Person.gender_source_concept_id)
+            .filter(*self._get_watermark_filters(Person.person_id, watermarks, after_watermarks))
+            .order_by(Person.person_id)
+        )
+        logging.debug(f"query for persons: {stmt}")
+        person_ids, year_of_birth, gender_source_concept_ids = self._fetch_columns(conn, stmt, 3)
+        add_count('persons', len(person_ids))
+        return (to_int_array(person_ids), to_int_array(year_of_birth), to_int_array(gender_source_concept_ids))
+
+    def _get_watermark_pks(self):
+        return [Person.person_id] + [columns[0] for columns in self.get_domain_columns().values()]
+
+    def _get_watermark_filters(self, pk, watermarks, after_watermarks=None, person_id=None):
+        max_id = watermarks[pk.table.name][1]
+        if (max_id is None):
+            return [false()]
+        filters = [pk <= max_id]
+        if (after_watermarks is not None and after_watermarks[pk.table.name][1] is not None):
+            appended = pk > after_watermarks[pk.table.name][1]
+            if (person_id is not None):
+                # rows of persons appended since were dropped when read before their person row, so they are read again
+                max_person_id = after_watermarks[Person.person_id.table.name][1]
+                appended = true() if max_person_id is None else or_(appended, person_id > max_person_id)
+            filters.append(appended)
+        return filters
+
+    def _fetch_domain_columns(self, conn, first_person_id=None, last_person_id=None, concept_filter=None, sampled_person_ids=None, watermarks=None, after_watermarks=None):
+        domain_columns = {}
+        for domain_id, (pk, person_id, concept_id, value, date) in self.get_domain_columns().items():
+            columns = [person_id, concept_id, date] if value is None else [person_id, concept_id, date, value]
+            stmt = (
+                select(*columns)
+                .order_by(person_id, pk)
+            )
+            if (first_person_id is not None):
+                stmt = stmt.filter(person_id.between(first_person_id, last_person_id))
+            if (sampled_person_ids is not None):
+                stmt = stmt.filter(person_id.in_(sampled_person_ids))
+            if (watermarks is not None):
+                stmt = stmt.filter(*self._get_watermark_filters(pk, watermarks, after_watermarks, person_id))
+            if (concept_filter is not None and not concept_filter[domain_id]):
+                fetched = [[] for _ in columns]
+            else:
+                if (concept_filter is not None):
+                    stmt = stmt.filter(concept_id.in_(concept_filter[domain_id]))
+                logging.debug(f"query for {domain_id} rows: {stmt}")
+                fetched = self._fetch_columns(conn, stmt, len(columns))
+            values = to_float_array(fetched[3]) if value is not None else np.full(len(fetched[0]), np.nan)
+            domain_columns[domain_id] = (to_int_array(fetched[0]), to_int_array(fetched[1]), values, to_date_array(fetched[2]))
+            add_count(f"{domain_id}_rows", len(fetched[0]))
+        return domain_columns
+
+    @profiled
+    def get_ehr_elig_flags(self, criteria):
+        presence_concept_ids = {}
+        for criterion in filter(is_presence_criterion, criteria):
+            presence_concept_ids.setdefault(criterion.domain_id, [])
+            if (criterion.concept_id not in presence_concept_ids[criterion.domain_id]):
+                presence_concept_ids[criterion.domain_id].append(criterion.concept_id)
+        lab_concept_ids = list(dict.fromkeys(criterion.concept_id for criterion in filter(is_measurement_criterion, criteria)))
+
+        stmt = select(Person.person_id, Person.year_of_birth, Person.gender_source_concept_id)
+        from_clause = Person.__table__
+        presence_keys = []
+        domain_columns = self.get_domain_columns()
+        for domain_id, concept_ids in presence_concept_ids.items():
+            pk, person_id, concept_id, value, date = domain_columns[domain_id]
+            counts = (
+                select(person_id.label('person_id'), *[funcfilter(func.count(), concept_id.in_(self._get_descendant_ids(flag_concept_id))) for flag_concept_id in concept_ids])
+                .filter(concept_id.in_(sorted(set().union(*map(self._get_descendant_ids, concept_ids)))))
+                .group_by(person_id)
+                .subquery()
+            )
+            from_clause = from_clause.outerjoin(counts, counts.c.person_id == Person.person_id)
+            stmt = stmt.add_columns(*list(counts.c)[1:])
+            presence_keys.extend((domain_id, flag_concept_id) for flag_concept_id in concept_ids)
+        for lab_concept_id in lab_concept_ids:
+            stmt = stmt.add_columns(self._get_lab_value_subquery(lab_concept_id))
+        stmt = stmt.select_from(from_clause).order_by(Person.person_id)
+        logging.debug(f"query for get_ehr_elig_flags: {stmt}")
+
+        num_columns = 3 + len(presence_keys) + len(lab_concept_ids)
+        with self.engine.connect() as conn:
+            columns = self._fetch_columns(conn, stmt, num_columns)
+        add_count('persons', len(columns[0]))
+        add_count('criteria', len(presence_keys) + len(lab_concept_ids))
+        presence_columns = columns[3:3 + len(presence_keys)]
+        lab_columns = columns[3 + len(presence_keys):]
+        presence = {key: to_int_array(counts, missing=0) > 0 for key, counts in zip(presence_keys, presence_columns)}
+        lab_values = {lab_concept_id: to_float_array(values) for lab_concept_id, values in zip(lab_concept_ids, lab_columns)}
+        return self.configure_snapshot(PushdownSnapshot(to_int_array(columns[0]), to_int_array(columns[1]), to_int_array(columns[2]), presence, lab_values))
+
+    def _get_lab_value_subquery(self, lab_concept_id):
+        if (self.lab_value_policy in ('latest', 'earliest')):
+            value = Measurement.value_as_number
+        else:
+            value = {'mean': func.avg, 'min': func.min, 'max': func.max}[self.lab_value_policy](Measurement.value_as_number)
+        stmt = (
+            select(value)
+            .filter(Measurement.person_id == Person.person_id)
+            .filter(Measurement.measurement_concept_id == lab_concept_id)
+            .filter(Measurement.value_as_number.isnot(None))
+        )
+        if (self.lab_value_policy == 'latest'):
+            stmt = stmt.order_by(Measurement.measurement_date.desc(), Measurement.measurement_id.desc()).limit(1)
+        elif (self.lab_value_policy == 'earliest'):
+            stmt = stmt.order_by(Measurement.measurement_date, Measurement.measurement_id).limit(1)
+        return stmt.scalar_subquery()
+
+    @profiled
+    def get_concept_closure(self, ancestor_concept_ids=None):
+        stmt = select(ConceptAncestor.ancestor_concept_id, ConceptAncestor.descendant_concept_id)
+        if (ancestor_concept_ids is not None):
+            stmt = stmt.filter(ConceptAncestor.ancestor_concept_id.in_(list(ancestor_concept_ids)))
+        logging.debug(f"query for get_concept_closure: {stmt}")
+        with self.engine.connect() as conn:
+            ancestor_concept_ids, descendant_concept_ids = self._fetch_columns(conn, stmt, 2)
+        return build_concept_closure(to_int_array(ancestor_concept_ids), to_int_array(descendant_concept_ids))
+
+    def get_concept_closure_fingerprint(self):
+        fingerprint = hashlib.sha256(f"{self.conn_str}".encode())
+        stmt = select(func.count(), func.max(ConceptAncestor.ancestor_concept_id), func.max(ConceptAncestor.descendant_concept_id))
+        with self.engine.connect() as conn:
+            fingerprint.update(f"|{conn.execute(stmt).one()}".encode())
+        return fingerprint.hexdigest()
+
+    @profiled
+    def get_cached_concept_closure(self, cache_dir):
+        path = os.path.join(cache_dir, f"closure-{self.get_concept_closure_fingerprint()}")
+        if (os.path.exists(os.path.join(path, 'meta.json'))):
+            return load_concept_closure(path)
+        save_concept_closure(self.get_concept_closure(), path)
+        return load_concept_closure(path)
+
+    def _get_descendant_ids(self, concept_id):
+        if (self.concept_closure is None):
+            return [concept_id]
+        return self.concept_closure.get_descendants(concept_id).tolist()
+
+    def get_temporal_window(self, index_date, lookback_days=None, observation_period=True):
+        if (not observation_period):
+            return TemporalWindow(index_date, lookback_days)
+        stmt = (
+            select(ObservationPeriod.person_id, func.min(ObservationPeriod.observation_period_start_date), func.max(ObservationPeriod.observation_period_end_date))
+            .filter(ObservationPeriod.observation_period_start_date <= index_date)
+            .filter(ObservationPeriod.observation_period_end_date >= index_date)
+            .group_by(ObservationPeriod.person_id)
+            .order_by(ObservationPeriod.person_id)
+        )
+        logging.debug(f"query for observation periods: {stmt}")
+        with self.engine.connect() as conn:
+            person_ids, start_dates, end_dates = self._fetch_columns(conn, stmt, 3)
+        return TemporalWindow(index_date, lookback_days, (to_int_array(person_ids), to_date_array(start_dates), to_date_array(end_dates)))
+
+    def apply_temporal_window(self, snapshot):
+        if (self.temporal_window is None):
+            return snapshot
+        return self.configure_snapshot(self.temporal_window.apply(snapshot))
+
+    def configure_snapshot(self, snapshot):
+        snapshot.concept_closure = self.concept_closure
+        snapshot.lab_value_policy = self.lab_value_policy
+        return snapshot
+
+    def _fetch_columns(self, conn, stmt, num_columns):
+        columns = [[] for _ in range(num_columns)]
+        result = conn.execution_options(stream_results=True).execute(stmt)
+        for partition in result.partitions(FETCH_PARTITION_SIZE):
+            for column, values in zip(columns, zip(*partition)):
+                column.extend(values)
+        return columns
@@ -0,0 +1,96 @@
+import datetime
+import hashlib
+import json
+import logging
+from sqlalchemy import create_engine, select, delete, insert, Column, DateTime, MetaData, String, Table, Text
+from gist.weights import get_weight_backend_id
+
+logger = logging.getLogger(__name__)
+
+# number of trial ids per IN clause, below the bound parameter limit of SQLite
+RESULT_QUERY_BATCH_SIZE = 500
+
+result_metadata = MetaData()
+
+gist_result = Table(
+    'gist_result', result_metadata,
+    Column('trial_id', String(255), primary_key=True),
+    Column('criteria_hash', String(64), primary_key=True),
+    Column('ehr_version', String(64), primary_key=True),
+    Column('settings_hash', String(64), primary_key=True),
+    Column('gist_score', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+)
+
+
+def get_criteria_hash(criteria):
+    rows = sorted(((criterion.concept_id, criterion.domain_id, criterion.cat_elig, criterion.lab_elig_min, criterion.lab_elig_max) for criterion in criteria), key=repr)
+    return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+
+def get_settings_hash(weight_backend, lab_value_policy, descendants, orm, streamed, temporal_window=None, era_domain_ids=(), concept_closure_version=None):
+    settings = (get_weight_backend_id(weight_backend), lab_value_policy, descendants, orm, streamed)
+    if (concept_closure_version is not None):
+        settings += (('concept_ancestor', concept_closure_version),)
+    if (temporal_window is not None):
+        settings += (temporal_window.get_key(),)
+    if (era_domain_ids):
+        settings += (('eras', tuple(sorted(era_domain_ids))),)
+    return hashlib.sha256(repr(settings).encode()).hexdigest()
+
+
+class ResultStore:
+    """Table of gist scores keyed by trial id, a hash of its criteria, the EHR version and the scoring settings."""
+
+    def __init__(self, conn_str, ehr_version, settings_hash):
+        self.engine = create_engine(conn_str)
+        self.ehr_version = ehr_version
+        self.settings_hash = settings_hash
+        result_metadata.create_all(self.engine)
+
+    def get_scores(self, criteria_by_trial_ids):
+        criteria_hashes = {criteria_by_trial_id['trial_id']: get_criteria_hash(criteria_by_trial_id['criteria']) for criteria_by_trial_id in criteria_by_trial_ids}
+        trial_ids = list(criteria_hashes)
+        gist_scores = {}
+        with self.engine.connect() as conn:
+            for start in range(0, len(trial_ids), RESULT_QUERY_BATCH_SIZE):
+                stmt = (
+                    select(gist_result.c.trial_id, gist_result.c.criteria_hash, gist_result.c.gist_score)
+                    .filter(gist_result.c.ehr_version == self.ehr_version)
+                    .filter(gist_result.c.settings_hash == self.settings_hash)
+                    .filter(gist_result.c.trial_id.in_(trial_ids[start:start + RESULT_QUERY_BATCH_SIZE]))
+                )
+                for trial_id, criteria_hash, gist_score in conn.execute(stmt):
+                    if (criteria_hashes[trial_id] == criteria_hash):
+                        gist_scores[trial_id] = json.loads(gist_score)
+        logger.info(f"found {len(gist_scores)} of {len(trial_ids)} trials in the result store")
+        return gist_scores
+
+    def put_scores(self, criteria_by_trial_ids, gist_scores):
+        # failed trials are left out so the next run retries them
+        criteria_by_trial_id = {criteria_by_trial_id['trial_id']: criteria_by_trial_id['criteria'] for criteria_by_trial_id in criteria_by_trial_ids}
+        created_at = datetime.datetime.now()
+        rows = {
+            gist_score['trial_id']: {
+                'trial_id': gist_score['trial_id'],
+                'criteria_hash': get_criteria_hash(criteria_by_trial_id[gist_score['trial_id']]),
+                'ehr_version': self.ehr_version,
+                'settings_hash': self.settings_hash,
+                'gist_score': json.dumps(gist_score),
+                'created_at': created_at,
+            }
+            for gist_score in gist_scores if 'error' not in gist_score
+        }
+        if (not rows):
+            return
+        trial_ids = list(rows)
+        with self.engine.begin() as conn:
+            for start in range(0, len(trial_ids), RESULT_QUERY_BATCH_SIZE):
+                conn.execute(
+                    delete(gist_result)
+                    .where(gist_result.c.ehr_version == self.ehr_version)
+                    .where(gist_result.c.settings_hash == self.settings_hash)
+                    .where(gist_result.c.trial_id.in_(trial_ids[start:start + RESULT_QUERY_BATCH_SIZE]))
+                )
+            conn.execute(insert(gist_result), list(rows.values()))
+        logger.info(f"stored {len(rows)} gist scores")
@@ -0,0 +1,99 @@
+import hashlib
+import logging
+from statistics import NormalDist
+import numpy as np
+from gist.core import get_elig_matrix, get_lab_criteria, get_lab_stats, get_lab_signature, get_signature_weights
+
+logger = logging.getLogger(__name__)
+
+
+def get_stratified_ratios(numerators, denominators, stratum_ids, population_sizes, z):
+    """Combined ratio estimates sum(y) / sum(x) of every numerator column with their normal approximation intervals.
+
+    Sampled persons are expanded by the inverse sampling fraction of their stratum. The variance
+    is the linearized variance of the ratio with the finite population correction of each stratum.
+    """
+    numerators = np.asarray(numerators, dtype=np.float64).reshape(len(stratum_ids), -1)
+    denominators = np.asarray(denominators, dtype=np.float64)
+    sample_sizes = np.bincount(stratum_ids, minlength=len(population_sizes)).astype(np.float64)
+    design_weights = (population_sizes / sample_sizes)[stratum_ids]
+    denominator_total = design_weights @ denominators
+    ratios = design_weights @ numerators / denominator_total
+
+    residuals = numerators - np.outer(denominators, ratios)
+    variances = np.zeros(numerators.shape[1])
+    for column in range(numerators.shape[1]):
+        sums = np.bincount(stratum_ids, residuals[:, column], minlength=len(population_sizes))
+        squares = np.bincount(stratum_ids, residuals[:, column] ** 2, minlength=len(population_sizes))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stratum_variances = np.where(sample_sizes > 1, (squares - sums ** 2 / sample_sizes) / (sample_sizes - 1), 0.0)
+        variances[column] = np.sum(population_sizes ** 2 * (1 - sample_sizes / population_sizes) * np.maximum(stratum_variances, 0.0) / sample_sizes) / denominator_total ** 2
+    half_widths = z * np.sqrt(variances)
+    # the numerators and denominators are non-negative, so are their ratios
+    return (ratios, np.maximum(ratios - half_widths, 0.0), ratios + half_widths)
+
+
+def get_sample_version(ehr_version, sample_fraction, seed, min_stratum_size):
+    return hashlib.sha256(repr((ehr_version, sample_fraction, seed, min_stratum_size)).encode()).hexdigest()
+
+
+def get_sampled_gist_score(trial_id, criteria, snapshot, stratum_ids, population_sizes, confidence=0.95, weight_backend=None, weight_cache=None):
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    lab_stats = get_lab_stats(get_lab_criteria(criteria), snapshot)
+    weights = np.asarray(get_signature_weights(get_lab_signature(criteria), lab_stats, snapshot, weight_backend, weight_cache), dtype=np.float64)
+    elig_matrix = get_elig_matrix(criteria, snapshot)
+
+    scores, lows, highs = get_stratified_ratios(weights[:, None] * elig_matrix, weights, stratum_ids, population_sizes, z)
+    gist_score = {
+        'trial_id': trial_id,
+        's_gist_scores': [{'concept_id': criterion.concept_id, 'score': float(score), 'ci': [float(low), float(high)]} for criterion, score, low, high in zip(criteria, scores, lows, highs)],
+    }
+
+    # zero s-GIST criteria are dropped by concept_id as in assemble_gist_score
+    zero_concept_ids = {criterion.concept_id for criterion, score in zip(criteria, scores) if score == 0}
+    kept_columns = [criterion.concept_id not in zero_concept_ids for criterion in criteria]
+    fully_eligible = elig_matrix[:, kept_columns].all(axis=1)
+    (m_gist_score,), (m_gist_low,), (m_gist_high,) = get_stratified_ratios(fully_eligible, weights, stratum_ids, population_sizes, z)
+    gist_score['m_gist_score'] = float(m_gist_score)
+    gist_score['m_gist_ci'] = [float(m_gist_low), float(m_gist_high)]
+    return gist_score
+
+
+def get_ci_width(gist_score):
+    widths = [s_gist_score['ci'][1] - s_gist_score['ci'][0] for s_gist_score in gist_score['s_gist_scores']]
+    return max(widths + [gist_score['m_gist_ci'][1] - gist_score['m_gist_ci'][0]])
+
+
+def get_sampled_gist_scores(criteria_by_trial_ids, ehr_repo, sample_fraction, target_width=None, confidence=0.95, seed=0, min_stratum_size=2, weight_backend=None, weight_cache=None, concept_filter=None):
+    """Estimates the gist scores of every trial on a stratified sample of the EHR.
+
+    With a target width the sample fraction is doubled, up to the whole population, until every
+    interval of a trial is at most that wide. The samples are nested, each one extending the last.
+    """
+    ehr_version = ehr_repo.get_ehr_fingerprint(concept_filter)
+    pending = list(criteria_by_trial_ids)
+    gist_scores = {}
+    rounds = 0
+    while (pending):
+        rounds += 1
+        snapshot, stratum_ids, population_sizes = ehr_repo.get_ehr_sample_snapshot(sample_fraction, seed, min_stratum_size, concept_filter)
+        snapshot.version = get_sample_version(ehr_version, sample_fraction, seed, min_stratum_size)
+        sample = {
+            'fraction': sample_fraction,
+            'persons': len(snapshot),
+            'population': int(population_sizes.sum()),
+            'strata': len(population_sizes),
+            'rounds': rounds,
+            'confidence': confidence,
+        }
+        remaining = []
+        for criteria_by_trial_id in pending:
+            gist_score = get_sampled_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], snapshot, stratum_ids, population_sizes, confidence, weight_backend, weight_cache)
+            gist_score['sample'] = sample
+            gist_scores[criteria_by_trial_id['trial_id']] = gist_score
+            if (target_width is not None and get_ci_width(gist_score) > target_width and len(snapshot) < sample['population']):
+                remaining.append(criteria_by_trial_id)
+        logger.info(f"scored {len(pending)} trials on {len(snapshot)} sampled persons, {len(remaining)} above the target interval width")
+        pending = remaining
+        sample_fraction = min(sample_fraction * 2, 1.0)
+    return [gist_scores[criteria_by_trial_id['trial_id']] for criteria_by_trial_id in criteria_by_trial_ids]
@@ -0,0 +1,244 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+import numpy as np
+from gist.index import ConceptIndex, build_concept_index, build_concept_postings, merge_concept_postings, save_concept_index, load_concept_index
+from gist.labs import DEFAULT_LAB_VALUE_POLICY, build_lab_table
+
+logger = logging.getLogger(__name__)
+
+DOMAIN_IDS = ('Condition', 'Drug', 'Procedure', 'Observation', 'Measurement')
+MISSING_GENDER_CONCEPT_ID = -1
+SNAPSHOT_FORMAT_VERSION = 2
+PERSON_ARRAYS = ('person_ids', 'year_of_birth', 'gender_source_concept_ids')
+DOMAIN_ARRAYS = ('offsets', 'concept_ids', 'values', 'dates')
+
+
+class DomainRows:
+    """CSR rows of one clinical domain: the rows of person i are [offsets[i], offsets[i + 1])."""
+
+    def __init__(self, offsets, concept_ids, values, dates):
+        self.offsets = offsets
+        self.concept_ids = concept_ids
+        self.values = values
+        self.dates = dates
+        self._person_index = None
+
+    def __len__(self):
+        return len(self.concept_ids)
+
+    @property
+    def num_persons(self):
+        return len(self.offsets) - 1
+
+    @property
+    def person_index(self):
+        if (self._person_index is None):
+            self._person_index = np.repeat(np.arange(self.num_persons), np.diff(self.offsets))
+        return self._person_index
+
+    def has_concept(self, concept_id):
+        mask = np.zeros(self.num_persons, dtype=bool)
+        mask[self.person_index[self.concept_ids == concept_id]] = True
+        return mask
+
+
+class EhrSnapshot:
+    """Columnar stand-in for the list of ``Person`` objects returned by ``EhrRepo.get_ehr``."""
+
+    def __init__(self, person_ids, year_of_birth, gender_source_concept_ids, domains, version=None, path=None):
+        self.person_ids = person_ids
+        self.year_of_birth = year_of_birth
+        self.gender_source_concept_ids = gender_source_concept_ids
+        self.domains = domains
+        self.version = version
+        self.path = path
+        self.concept_index = None
+        self.concept_closure = None
+        self.lab_value_policy = DEFAULT_LAB_VALUE_POLICY
+        self.lab_table = None
+        # (row count, max primary key) per table the snapshot was read up to, and the database and concepts it was read from
+        self.watermarks = None
+        self.source = None
+        # date ages are computed at, today unless the snapshot was windowed to an index date
+        self.index_date = None
+
+    def __len__(self):
+        return len(self.person_ids)
+
+    def __repr__(self):
+        rows = ', '.join(f"{domain_id}={len(rows)}" for domain_id, rows in self.domains.items())
+        return f"EhrSnapshot(persons={len(self)}, {rows})"
+
+    def append(self, person_columns, domain_columns):
+        """Patches in persons with ids above the current ones and rows appended to the domains, updating the concept index."""
+        person_ids, year_of_birth, gender_source_concept_ids = person_columns
+        order = np.argsort(person_ids, kind='stable')
+        self.person_ids = np.concatenate((self.person_ids, person_ids[order]))
+        self.year_of_birth = np.concatenate((self.year_of_birth, year_of_birth[order]))
+        self.gender_source_concept_ids = np.concatenate((self.gender_source_concept_ids, gender_source_concept_ids[order]))
+        postings = dict(self.concept_index.postings) if self.concept_index is not None else None
+        for domain_id, (row_person_ids, concept_ids, values, dates) in domain_columns.items():
+            delta = build_domain_rows(self.person_ids, row_person_ids, concept_ids, values, dates)
+            self.domains[domain_id] = merge_domain_rows(self.domains[domain_id], delta)
+            if (postings is not None and len(delta)):
+                postings[domain_id] = merge_concept_postings(postings[domain_id], build_concept_postings(delta))
+            if (domain_id == 'Measurement' and len(delta)):
+                self.lab_table = None
+        if (postings is not None):
+            self.concept_index = ConceptIndex(len(self), postings)
+        self.path = None
+        logger.info(f"appended {len(person_ids)} persons and {sum(len(columns[1]) for columns in domain_columns.values())} rows to {self}")
+
+    def ages(self):
+        return (self.index_date or datetime.date.today()).year - self.year_of_birth
+
+    def get_concept_index(self):
+        if (self.concept_index is None):
+            self.concept_index = build_concept_index(self)
+        return self.concept_index
+
+    def has_concept(self, domain_id, concept_id):
+        if (self.concept_closure is not None):
+            return self.get_concept_index().get_union_mask(domain_id, self.concept_closure.get_descendants(concept_id))
+        return self.get_concept_index().get_mask(domain_id, concept_id)
+
+    def get_lab_table(self):
+        if (self.lab_table is None or self.lab_table.policy != self.lab_value_policy):
+            self.lab_table = build_lab_table(self.domains['Measurement'], self.lab_value_policy)
+        return self.lab_table
+
+    def lab_values(self, concept_id):
+        return self.get_lab_table().get_values(concept_id)
+
+
+class PushdownSnapshot(EhrSnapshot):
+    """Person attributes plus only the per-criterion flags and lab values computed inside the database."""
+
+    def __init__(self, person_ids, year_of_birth, gender_source_concept_ids, presence, lab_values):
+        super().__init__(person_ids, year_of_birth, gender_source_concept_ids, {})
+        self.presence = presence
+        self.lab_value_columns = lab_values
+
+    def __repr__(self):
+        return f"PushdownSnapshot(persons={len(self)}, presence={len(self.presence)}, lab_values={len(self.lab_value_columns)})"
+
+    def has_concept(self, domain_id, concept_id):
+        return self.presence[(domain_id, concept_id)]
+
+    def lab_values(self, concept_id):
+        return self.lab_value_columns[concept_id]
+
+
+def build_domain_rows(person_ids, row_person_ids, concept_ids, values, dates):
+    person_index = np.searchsorted(person_ids, row_person_ids)
+    # rows of persons missing from person are dropped, as the ORM relationships never reach them
+    is_known = person_index < len(person_ids)
+    is_known[is_known] = person_ids[person_index[is_known]] == row_person_ids[is_known]
+    if (not is_known.all()):
+        logger.warning(f"dropped {len(is_known) - int(is_known.sum())} rows of persons missing from the person table")
+        person_index, concept_ids, values, dates = person_index[is_known], concept_ids[is_known], values[is_known], dates[is_known]
+    order = np.argsort(person_index, kind='stable')
+    counts = np.bincount(person_index, minlength=len(person_ids))
+    offsets = np.zeros(len(person_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return DomainRows(offsets, concept_ids[order], values[order], dates[order])
+
+
+def merge_domain_rows(rows, delta):
+    # the rows of delta, over all persons, go after the rows each person already has
+    old_counts = np.zeros(delta.num_persons, dtype=np.int64)
+    old_counts[:rows.num_persons] = np.diff(rows.offsets)
+    delta_counts = np.diff(delta.offsets)
+    offsets = np.zeros(delta.num_persons + 1, dtype=np.int64)
+    np.cumsum(old_counts + delta_counts, out=offsets[1:])
+    old_positions = np.arange(len(rows)) + np.repeat(offsets[:rows.num_persons] - rows.offsets[:-1], old_counts[:rows.num_persons])
+    delta_positions = np.arange(len(delta)) + np.repeat(offsets[:-1] + old_counts - delta.offsets[:-1], delta_counts)
+    arrays = []
+    for name in DOMAIN_ARRAYS[1:]:
+        old_array, delta_array = getattr(rows, name), getattr(delta, name)
+        array = np.empty(offsets[-1], dtype=old_array.dtype)
+        array[old_positions] = old_array
+        array[delta_positions] = delta_array
+        arrays.append(array)
+    return DomainRows(offsets, *arrays)
+
+
+def build_snapshot(person_columns, domain_columns):
+    person_ids, year_of_birth, gender_source_concept_ids = person_columns
+    order = np.argsort(person_ids, kind='stable')
+    person_ids = person_ids[order]
+    domains = {}
+    for domain_id, (row_person_ids, concept_ids, values, dates) in domain_columns.items():
+        domains[domain_id] = build_domain_rows(person_ids, row_person_ids, concept_ids, values, dates)
+    snapshot = EhrSnapshot(person_ids, year_of_birth[order], gender_source_concept_ids[order], domains)
+    logger.debug(f"built {snapshot}")
+    return snapshot
+
+
+def to_int_array(column, missing=MISSING_GENDER_CONCEPT_ID):
+    return np.fromiter((missing if value is None else value for value in column), dtype=np.int64, count=len(column))
+
+
+def to_float_array(column):
+    return np.fromiter((np.nan if value is None else float(value) for value in column), dtype=np.float64, count=len(column))
+
+
+def to_date_array(column):
+    return np.array(column, dtype='datetime64[D]')
+
+
+def save_snapshot(snapshot, path):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path)
+    for name in PERSON_ARRAYS:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(snapshot, name))
+    for domain_id, rows in snapshot.domains.items():
+        for name in DOMAIN_ARRAYS:
+            np.save(os.path.join(tmp_path, f"{domain_id}.{name}.npy"), getattr(rows, name))
+    save_concept_index(snapshot.get_concept_index(), tmp_path)
+    meta = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'version': snapshot.version,
+        'domain_ids': list(snapshot.domains),
+        'watermarks': snapshot.watermarks,
+        'source': snapshot.source,
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    if (os.path.exists(path)):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    logger.info(f"saved {snapshot} to {path}")
+
+
+def load_snapshot(path, mmap_mode='r'):
+    with open(os.path.join(path, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    if (meta['format_version'] != SNAPSHOT_FORMAT_VERSION):
+        raise ValueError(f"snapshot at {path} has format version {meta['format_version']}, expected {SNAPSHOT_FORMAT_VERSION}")
+    person_arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in PERSON_ARRAYS]
+    domains = {}
+    for domain_id in meta['domain_ids']:
+        domains[domain_id] = DomainRows(*[np.load(os.path.join(path, f"{domain_id}.{name}.npy"), mmap_mode=mmap_mode) for name in DOMAIN_ARRAYS])
+    snapshot = EhrSnapshot(*person_arrays, domains, version=meta['version'], path=path if mmap_mode else None)
+    snapshot.concept_index = load_concept_index(path, len(snapshot), meta['domain_ids'], mmap_mode=mmap_mode)
+    snapshot.watermarks = {table_name: tuple(watermark) for table_name, watermark in meta['watermarks'].items()} if meta.get('watermarks') else None
+    snapshot.source = meta.get('source')
+    logger.info(f"loaded {snapshot} from {path}")
+    return snapshot
+
+
+def find_snapshot(cache_dir, source):
+    # latest snapshot in the cache read from the same database and concepts, which a refresh can start from
+    paths = []
+    for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        meta_path = os.path.join(cache_dir, name, 'meta.json')
+        if (os.path.exists(meta_path)):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if (meta.get('format_version') == SNAPSHOT_FORMAT_VERSION and meta.get('source') == source and meta.get('watermarks')):
+                paths.append(os.path.join(cache_dir, name))
+    return max(paths, key=os.path.getmtime, default=None)
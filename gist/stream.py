@@ -0,0 +1,206 @@
+import logging
+import math
+import numpy as np
+from gist.core import AGE_CONCEPT_ID, get_lab_criteria, get_features_and_labels, get_elig_matrix, get_standardized_mean
+from gist.repo import SAMPLE_HASH_MULTIPLIER, SAMPLE_HASH_MODULUS
+from gist.snapshot import PushdownSnapshot
+from gist.weights import fit_weight_model, predict_weights
+from gist.profiling import profiled
+
+logger = logging.getLogger(__name__)
+
+# persons the streamed weight model is fitted on, populations up to this size are fitted on in full
+TRAINING_SAMPLE_SIZE = 10000
+
+
+class RunningLabStats:
+    """Single-pass mean/variance (Welford, merged per chunk with Chan's formula) and ineligible count of one lab."""
+
+    def __init__(self, criterion):
+        self.criterion = criterion
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.num_inelig = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if (len(values) == 0):
+            return
+        chunk_count = len(values)
+        chunk_mean = float(values.mean())
+        chunk_m2 = float(np.square(values - chunk_mean).sum())
+
+        count = self.count + chunk_count
+        delta = chunk_mean - self.mean
+        self.mean += delta * chunk_count / count
+        self.m2 += chunk_m2 + delta * delta * self.count * chunk_count / count
+        self.count = count
+        self.num_inelig += int(np.count_nonzero((self.criterion.lab_elig_min >= values) | (values >= self.criterion.lab_elig_max)))
+
+    def get_lab_stat(self):
+        if (self.count == 0):
+            logger.warning(f"no values for lab {self.criterion.concept_id}, using empty lab stats")
+        lab_stat = {
+            'criterion': self.criterion,
+            'mean': self.mean,
+            'inelig_prec': self.num_inelig / self.count if self.count else 0.0,
+            'std_dev': math.sqrt(self.m2 / self.count) if self.count else 0.0,
+        }
+        lab_stat['norm_min'] = float(self.criterion.lab_elig_min - get_standardized_mean(lab_stat))
+        lab_stat['norm_max'] = float(self.criterion.lab_elig_max - get_standardized_mean(lab_stat))
+        return lab_stat
+
+
+class ZeroScoreTracker:
+    """Counts fully eligible persons over the criteria left once zero s-GIST criteria are dropped.
+
+    A criterion scores zero exactly when nobody is eligible for it, which is only known after the
+    last chunk. Persons are therefore counted per pattern of failed criteria, keeping only patterns
+    that can still be contained in the final set of dropped criteria.
+    """
+
+    def __init__(self, criteria):
+        self.concept_ids = np.array([criterion.concept_id for criterion in criteria])
+        self.any_eligible = np.zeros(len(criteria), dtype=bool)
+        self.failure_counts = {}
+
+    def get_droppable(self):
+        zero_concept_ids = self.concept_ids[~self.any_eligible]
+        return np.isin(self.concept_ids, zero_concept_ids)
+
+    def update(self, elig_matrix):
+        self.any_eligible |= elig_matrix.any(axis=0)
+        droppable = self.get_droppable()
+        failures = ~elig_matrix
+        candidates = failures[~(failures & ~droppable).any(axis=1)]
+        if (len(candidates)):
+            patterns, counts = np.unique(candidates, axis=0, return_counts=True)
+            for pattern, count in zip(patterns, counts):
+                key = pattern.tobytes()
+                self.failure_counts[key] = self.failure_counts.get(key, 0) + int(count)
+        self.failure_counts = {key: count for key, count in self.failure_counts.items() if not (np.frombuffer(key, dtype=bool) & ~droppable).any()}
+
+    def get_num_fully_eligible(self):
+        return sum(self.failure_counts.values())
+
+
+class TrainingSample:
+    """Stratified sample of the persons of all chunks by age, which the streamed weight model is fitted on.
+
+    Within each age, persons are ranked by a hash of their person_id and the first ``sample_size`` are
+    kept, so the sample does not depend on the chunk size and at most ``sample_size`` persons per age
+    are held. Once the stratum sizes are known, each stratum contributes its proportional quota as
+    in ``get_stratified_sample``.
+    """
+
+    def __init__(self, lab_concept_ids, sample_size=TRAINING_SAMPLE_SIZE, seed=0):
+        self.lab_concept_ids = [concept_id for concept_id in lab_concept_ids if concept_id != AGE_CONCEPT_ID]
+        self.sample_size = sample_size
+        self.seed = seed
+        self.columns = None
+        self.stratum_sizes = {}
+        self.num_persons = 0
+        self.index_date = None
+
+    def update(self, chunk):
+        ages = chunk.ages()
+        columns = {
+            'age': ages,
+            'hash': (chunk.person_ids + self.seed) * SAMPLE_HASH_MULTIPLIER % SAMPLE_HASH_MODULUS,
+            'person_ids': chunk.person_ids,
+            'year_of_birth': chunk.year_of_birth,
+            'gender_source_concept_ids': chunk.gender_source_concept_ids,
+        }
+        columns.update((concept_id, chunk.lab_values(concept_id)) for concept_id in self.lab_concept_ids)
+        if (self.columns is not None):
+            columns = {name: np.concatenate((self.columns[name], column)) for name, column in columns.items()}
+        for age, count in zip(*np.unique(ages, return_counts=True)):
+            self.stratum_sizes[age] = self.stratum_sizes.get(age, 0) + int(count)
+        self.num_persons += len(chunk)
+        self.index_date = chunk.index_date
+        kept = self.get_first_in_strata(columns, lambda age: self.sample_size)
+        self.columns = {name: column[kept] for name, column in columns.items()}
+
+    def get_first_in_strata(self, columns, get_quota):
+        order = np.lexsort((columns['person_ids'], columns['hash'], columns['age']))
+        ages = columns['age'][order]
+        is_first = np.ones(len(ages), dtype=bool)
+        is_first[1:] = ages[1:] != ages[:-1]
+        stratum_starts = np.flatnonzero(is_first)
+        stratum_sizes = np.diff(np.append(stratum_starts, len(ages)))
+        rank_in_stratum = np.arange(len(ages)) - np.repeat(stratum_starts, stratum_sizes)
+        quotas = np.array([get_quota(age) for age in ages[stratum_starts]], dtype=np.int64)
+        return np.sort(order[rank_in_stratum < np.repeat(quotas, stratum_sizes)])
+
+    def get_snapshot(self):
+        sample_size = min(self.sample_size, self.num_persons)
+        kept = self.get_first_in_strata(self.columns, lambda age: math.ceil(self.stratum_sizes[age] * sample_size / self.num_persons))
+        # in person_id order, as the whole EHR is fitted on without chunks
+        kept = kept[np.argsort(self.columns['person_ids'][kept], kind='stable')]
+        sample = PushdownSnapshot(
+            self.columns['person_ids'][kept], self.columns['year_of_birth'][kept], self.columns['gender_source_concept_ids'][kept],
+            {}, {concept_id: self.columns[concept_id][kept] for concept_id in self.lab_concept_ids},
+        )
+        sample.index_date = self.index_date
+        return sample
+
+
+@profiled
+def get_streamed_lab_stats(lab_criteria, chunks, training_sample=None):
+    running_stats = {lab_criterion.concept_id: RunningLabStats(lab_criterion) for lab_criterion in lab_criteria}
+    num_persons = 0
+    for chunk in chunks:
+        num_persons += len(chunk)
+        for concept_id, running_stat in running_stats.items():
+            running_stat.update(chunk.ages() if concept_id == AGE_CONCEPT_ID else chunk.lab_values(concept_id))
+        if (training_sample is not None):
+            training_sample.update(chunk)
+    logger.debug(f"streamed lab stats over {num_persons} persons")
+    return {concept_id: running_stat.get_lab_stat() for concept_id, running_stat in running_stats.items()}
+
+
+@profiled
+def get_streamed_gist_score(trial_id, criteria, get_chunks, weight_backend=None, training_sample_size=TRAINING_SAMPLE_SIZE):
+    lab_criteria = get_lab_criteria(criteria)
+
+    # the weight model is fitted on a sample of all chunks, the first chunk alone is not a random sample
+    training_sample = TrainingSample([lab_criterion.concept_id for lab_criterion in lab_criteria], training_sample_size)
+    lab_stats = get_streamed_lab_stats(lab_criteria, get_chunks(), training_sample)
+    logger.info(f"calculated {len(lab_stats)} lab stats")
+    sample = training_sample.get_snapshot()
+    weight_model = fit_weight_model(*get_features_and_labels(lab_stats, sample), weight_backend)
+    logger.info(f"fitted weight model on a stratified sample of {len(sample)} of {training_sample.num_persons} persons")
+
+    num_persons = 0
+    sum_weights = 0.0
+    weighted_elig = np.zeros(len(criteria))
+    zero_score_tracker = ZeroScoreTracker(criteria)
+    for chunk in get_chunks():
+        features, labels = get_features_and_labels(lab_stats, chunk)
+        weights = predict_weights(weight_model, features, labels)
+
+        elig_matrix = get_elig_matrix(criteria, chunk)
+        num_persons += len(chunk)
+        sum_weights += float(weights.sum())
+        weighted_elig += weights @ elig_matrix
+        zero_score_tracker.update(elig_matrix)
+        logger.debug(f"scored chunk of {len(chunk)} persons ({num_persons} so far)")
+    logger.info(f"checked eligibility for {num_persons} EHRs")
+
+    gist_score = {
+        'trial_id': trial_id
+    }
+    gist_score['s_gist_scores'] = [{'concept_id': criterion.concept_id, 'score': float(score)} for criterion, score in zip(criteria, weighted_elig / sum_weights)]
+
+    zero_concept_ids = [s_gist_score['concept_id'] for s_gist_score in gist_score['s_gist_scores'] if s_gist_score['score'] == 0]
+    if (zero_concept_ids):
+        logger.info(f"found {len(zero_concept_ids)} s_gist_score(s) with a score of zero")
+        logger.info(f"removing {zero_concept_ids} from analysis")
+    else:
+        logger.info("no zeros in s gist scores found")
+    num_fully_eligible = zero_score_tracker.get_num_fully_eligible()
+    logger.debug(f'Number of Fully Eligible People: {num_fully_eligible}')
+    gist_score['m_gist_score'] = num_fully_eligible / sum_weights
+    return gist_score
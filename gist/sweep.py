@@ -0,0 +1,88 @@
+import logging
+import numpy as np
+from gist.core import AGE_CONCEPT_ID, get_lab_criteria
+
+logger = logging.getLogger(__name__)
+
+
+class LabRangeSweep:
+    """Sorted values of one lab with prefix sums of the weights and of the persons eligible for every other criterion.
+
+    The s-GIST and m-GIST scores of any (lab_elig_min, lab_elig_max) range are then two binary searches.
+    """
+
+    def __init__(self, criterion, values, weights, rest_mask, sum_weights, num_rest=None, always_dropped=False):
+        self.criterion = criterion
+        values = np.asarray(values, dtype=np.float64)
+        present = ~np.isnan(values)
+        order = np.argsort(values[present], kind='stable')
+        self.sorted_values = values[present][order]
+        self.weight_prefix = np.concatenate(([0.0], np.cumsum(np.asarray(weights, dtype=np.float64)[present][order])))
+        self.rest_prefix = np.concatenate(([0], np.cumsum(np.asarray(rest_mask, dtype=np.int64)[present][order])))
+        self.sum_weights = sum_weights
+        self.num_rest = int(np.count_nonzero(rest_mask)) if num_rest is None else num_rest
+        self.always_dropped = always_dropped
+
+    def query(self, lab_elig_min, lab_elig_max):
+        start = np.searchsorted(self.sorted_values, lab_elig_min, side='left')
+        end = np.searchsorted(self.sorted_values, lab_elig_max, side='right')
+        if (end < start):
+            end = start
+        if (self.criterion.cat_elig == 1):
+            weight = self.weight_prefix[end] - self.weight_prefix[start]
+            num_fully_eligible = self.rest_prefix[end] - self.rest_prefix[start]
+        elif (self.criterion.cat_elig == 0):
+            weight = self.weight_prefix[-1] - (self.weight_prefix[end] - self.weight_prefix[start])
+            num_fully_eligible = self.rest_prefix[-1] - (self.rest_prefix[end] - self.rest_prefix[start])
+        else:
+            weight = 0.0
+            num_fully_eligible = 0
+        s_gist_score = float(weight / self.sum_weights)
+        if (self.always_dropped or s_gist_score == 0):
+            num_fully_eligible = self.num_rest
+        return (s_gist_score, float(num_fully_eligible / self.sum_weights))
+
+    def get_curve(self, ranges):
+        curve = []
+        for lab_elig_min, lab_elig_max in ranges:
+            s_gist_score, m_gist_score = self.query(lab_elig_min, lab_elig_max)
+            curve.append({
+                'lab_elig_min': float(lab_elig_min),
+                'lab_elig_max': float(lab_elig_max),
+                's_gist_score': s_gist_score,
+                'm_gist_score': m_gist_score,
+            })
+        return curve
+
+
+def get_scaled_ranges(criterion, steps, spread):
+    center = (float(criterion.lab_elig_min) + float(criterion.lab_elig_max)) / 2
+    half_width = (float(criterion.lab_elig_max) - float(criterion.lab_elig_min)) / 2
+    return [(center - half_width * factor, center + half_width * factor) for factor in np.linspace(max(1 - spread, 0), 1 + spread, steps)]
+
+
+def get_lab_range_sweep(scorer, index, ehr):
+    criterion = scorer.criteria[index]
+    values = ehr.ages() if criterion.concept_id == AGE_CONCEPT_ID else ehr.lab_values(criterion.concept_id)
+    always_dropped = any(active and score == 0 and other.concept_id == criterion.concept_id for other_index, (other, score, active) in enumerate(zip(scorer.criteria, scorer.scores, scorer.active)) if other_index != index)
+    scorer.remove_criterion(index)
+    rest_mask = scorer.failure_counts == 0
+    scorer.restore_criterion(index)
+    return LabRangeSweep(criterion, values, scorer.weights, rest_mask, scorer.sum_weights, always_dropped=always_dropped)
+
+
+def get_lab_range_curves(scorer, ehr, steps=50, spread=0.5):
+    lab_criteria = get_lab_criteria(scorer.criteria)
+    curves = []
+    for index, criterion in enumerate(scorer.criteria):
+        if (criterion not in lab_criteria):
+            continue
+        sweep = get_lab_range_sweep(scorer, index, ehr)
+        curves.append({
+            'concept_id': criterion.concept_id,
+            'lab_elig_min': criterion.lab_elig_min,
+            'lab_elig_max': criterion.lab_elig_max,
+            'curve': sweep.get_curve(get_scaled_ranges(criterion, steps, spread)),
+        })
+    logger.info(f"swept {len(curves)} lab criteria of {scorer.trial_id} over {steps} ranges each")
+    return curves
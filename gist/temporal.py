@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import numpy as np
+from gist.snapshot import DomainRows, EhrSnapshot
+
+logger = logging.getLogger(__name__)
+
+# days are clipped to 32 bits so (person index, day) pairs fit one sortable int64 key
+MIN_DAY = -2 ** 31
+MAX_DAY = 2 ** 31 - 1
+
+
+class TemporalWindow:
+    """Index date and per-domain lookback days that criteria are evaluated in, within each person's observation period when given.
+
+    ``observation_periods`` is a tuple of sorted person_ids and the start and end dates of the period
+    containing the index date. Persons without one are not observed at the index date and left out.
+    """
+
+    def __init__(self, index_date, lookback_days=None, observation_periods=None):
+        self.index_date = np.datetime64(index_date, 'D')
+        self.lookback_days = dict(lookback_days or {})
+        self.observation_periods = observation_periods
+
+    def __repr__(self):
+        return f"TemporalWindow(index_date={self.index_date}, lookback_days={self.lookback_days}, observation_periods={self.observation_periods is not None})"
+
+    def get_key(self):
+        # the periods are hashed, so reloading observation_period changes the key of the windowed population
+        observation_periods = None
+        if (self.observation_periods is not None):
+            observation_periods = hashlib.sha256(b''.join(np.ascontiguousarray(array).tobytes() for array in self.observation_periods)).hexdigest()
+        return (str(self.index_date), sorted(self.lookback_days.items()), observation_periods)
+
+    def apply(self, snapshot):
+        person_indices = np.arange(len(snapshot))
+        period_starts = np.full(len(snapshot), MIN_DAY, dtype=np.int64)
+        if (self.observation_periods is not None):
+            period_person_ids, period_start_dates, period_end_dates = self.observation_periods
+            positions = np.minimum(np.searchsorted(period_person_ids, snapshot.person_ids), max(len(period_person_ids) - 1, 0))
+            is_observed = period_person_ids[positions] == snapshot.person_ids if len(period_person_ids) else np.zeros(len(snapshot), dtype=bool)
+            person_indices = np.flatnonzero(is_observed)
+            period_starts = to_days(period_start_dates[positions[is_observed]])
+            logger.info(f"{len(person_indices)} of {len(snapshot)} persons are observed at {self.index_date}")
+
+        index_day = int(to_days(self.index_date))
+        domains = {}
+        for domain_id, rows in snapshot.domains.items():
+            window_starts = period_starts
+            if (self.lookback_days.get(domain_id) is not None):
+                window_starts = np.maximum(window_starts, index_day - self.lookback_days[domain_id])
+            rows = sort_rows_by_date(rows)
+            starts, ends = get_window_bounds(rows, person_indices, window_starts, index_day)
+            domains[domain_id] = select_rows(rows, starts, ends)
+
+        version = None
+        if (snapshot.version is not None):
+            version = hashlib.sha256(repr((snapshot.version, self.get_key())).encode()).hexdigest()
+        windowed = EhrSnapshot(snapshot.person_ids[person_indices], snapshot.year_of_birth[person_indices], snapshot.gender_source_concept_ids[person_indices], domains, version=version)
+        windowed.index_date = self.index_date.astype(object)
+        logger.debug(f"windowed {snapshot} to {windowed}")
+        return windowed
+
+
+def to_days(dates):
+    return np.clip(np.asarray(dates, dtype='datetime64[D]').astype(np.int64), MIN_DAY, MAX_DAY)
+
+
+def get_row_keys(rows):
+    return (rows.person_index.astype(np.int64) << 32) | (to_days(rows.dates) - MIN_DAY)
+
+
+def sort_rows_by_date(rows):
+    # stable, so rows of one person on one date stay in primary key order
+    keys = get_row_keys(rows)
+    if (np.all(keys[1:] >= keys[:-1])):
+        return rows
+    order = np.argsort(keys, kind='stable')
+    return DomainRows(rows.offsets, rows.concept_ids[order], rows.values[order], rows.dates[order])
+
+
+def get_window_bounds(rows, person_indices, window_starts, window_end):
+    """Row ranges [starts, ends) of each person's rows dated within the window, by binary search of date sorted rows."""
+    keys = get_row_keys(rows)
+    person_keys = person_indices.astype(np.int64) << 32
+    starts = np.searchsorted(keys, person_keys | (window_starts - MIN_DAY), side='left')
+    ends = np.searchsorted(keys, person_keys | (window_end - MIN_DAY), side='right')
+    return (starts, np.maximum(starts, ends))
+
+
+def select_rows(rows, starts, ends):
+    counts = ends - starts
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    take = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)
+    return DomainRows(offsets, rows.concept_ids[take], rows.values[take], rows.dates[take])
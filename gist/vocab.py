@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import shutil
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CLOSURE_ARRAYS = ('ancestor_concept_ids', 'offsets', 'descendant_concept_ids')
+
+
+class ConceptClosure:
+    """Descendants of every ancestor concept_id from concept_ancestor: descendants of ancestor_concept_ids[i] are descendant_concept_ids[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self, ancestor_concept_ids, offsets, descendant_concept_ids):
+        self.ancestor_concept_ids = ancestor_concept_ids
+        self.offsets = offsets
+        self.descendant_concept_ids = descendant_concept_ids
+        self.expanded = {}
+
+    def __repr__(self):
+        return f"ConceptClosure(ancestors={len(self.ancestor_concept_ids)}, pairs={len(self.descendant_concept_ids)})"
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['expanded'] = {}
+        return state
+
+    def get_descendants(self, concept_id):
+        if (concept_id not in self.expanded):
+            position = np.searchsorted(self.ancestor_concept_ids, concept_id)
+            if (position < len(self.ancestor_concept_ids) and self.ancestor_concept_ids[position] == concept_id):
+                descendants = self.descendant_concept_ids[self.offsets[position]:self.offsets[position + 1]]
+            else:
+                descendants = self.descendant_concept_ids[0:0]
+            self.expanded[concept_id] = np.union1d(descendants, [concept_id])
+        return self.expanded[concept_id]
+
+
+def build_concept_closure(ancestor_concept_ids, descendant_concept_ids):
+    order = np.lexsort((descendant_concept_ids, ancestor_concept_ids))
+    ancestor_concept_ids = ancestor_concept_ids[order]
+    descendant_concept_ids = descendant_concept_ids[order]
+    unique_ancestor_concept_ids, counts = np.unique(ancestor_concept_ids, return_counts=True)
+    offsets = np.zeros(len(unique_ancestor_concept_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    concept_closure = ConceptClosure(unique_ancestor_concept_ids, offsets, descendant_concept_ids)
+    logger.debug(f"built {concept_closure}")
+    return concept_closure
+
+
+def save_concept_closure(concept_closure, path):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path)
+    for name in CLOSURE_ARRAYS:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(concept_closure, name))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+        json.dump({'pairs': len(concept_closure.descendant_concept_ids)}, meta_file)
+    if (os.path.exists(path)):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    logger.info(f"saved {concept_closure} to {path}")
+
+
+def load_concept_closure(path, mmap_mode='r'):
+    concept_closure = ConceptClosure(*[np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in CLOSURE_ARRAYS])
+    logger.info(f"loaded {concept_closure} from {path}")
+    return concept_closure
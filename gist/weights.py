@@ -0,0 +1,193 @@
+import functools
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+import numpy as np
+from sklearn import svm
+from sklearn import preprocessing
+from sklearn import linear_model
+from sklearn import kernel_approximation
+from sklearn import pipeline
+from gist.profiling import profiled, add_count
+
+logger = logging.getLogger(__name__)
+
+# Every backend fits on (features, labels) and returns a function predicting labels from features.
+
+
+def fit_svc_model(features, labels):
+    lab_enc = preprocessing.LabelEncoder()
+    encoded_labels = lab_enc.fit_transform(labels)
+    clf = svm.SVC(gamma='auto')
+    clf.fit(features, encoded_labels)
+    return lambda features: lab_enc.inverse_transform(clf.predict(features))
+
+
+def fit_linear_model(features, labels, alpha=1.0):
+    reg = linear_model.Ridge(alpha=alpha)
+    reg.fit(features, labels)
+    return reg.predict
+
+
+def fit_sgd_model(features, labels, batch_size=10000, epochs=5, seed=0):
+    rng = np.random.default_rng(seed)
+    scaler = preprocessing.StandardScaler()
+    for start in range(0, len(features), batch_size):
+        scaler.partial_fit(features[start:start + batch_size])
+    reg = linear_model.SGDRegressor(random_state=seed)
+    for _ in range(epochs):
+        order = rng.permutation(len(features))
+        for start in range(0, len(features), batch_size):
+            batch = order[start:start + batch_size]
+            reg.partial_fit(scaler.transform(features[batch]), labels[batch])
+    return lambda features: reg.predict(scaler.transform(features))
+
+
+def fit_nystroem_model(features, labels, n_components=300, alpha=1.0, seed=0):
+    reg = pipeline.make_pipeline(
+        kernel_approximation.Nystroem(kernel='rbf', gamma=1 / features.shape[1], n_components=min(n_components, len(features)), random_state=seed),
+        linear_model.Ridge(alpha=alpha),
+    )
+    reg.fit(features, labels)
+    return reg.predict
+
+
+def fit_subsample_svc_model(features, labels, sample_size=10000, seed=0):
+    if (len(features) <= sample_size):
+        return fit_svc_model(features, labels)
+    sample = get_stratified_sample(labels, sample_size, seed)
+    logger.debug(f"fitting svc on a stratified subsample of {len(sample)} of {len(features)} persons")
+    return fit_svc_model(features[sample], labels[sample])
+
+
+def get_stratified_sample(labels, sample_size, seed=0):
+    rng = np.random.default_rng(seed)
+    strata, stratum_index = np.unique(labels, return_inverse=True)
+    order = rng.permutation(len(labels))
+    order = order[np.argsort(stratum_index[order], kind='stable')]
+    stratum_sizes = np.bincount(stratum_index, minlength=len(strata))
+    stratum_starts = np.concatenate(([0], np.cumsum(stratum_sizes)[:-1]))
+    rank_in_stratum = np.arange(len(labels)) - np.repeat(stratum_starts, stratum_sizes)
+    quotas = np.ceil(stratum_sizes * sample_size / len(labels)).astype(np.int64)
+    return np.sort(order[rank_in_stratum < np.repeat(quotas, stratum_sizes)])
+
+
+WEIGHT_BACKENDS = {
+    'svc': fit_svc_model,
+    'linear': fit_linear_model,
+    'sgd': fit_sgd_model,
+    'nystroem': fit_nystroem_model,
+    'subsample': fit_subsample_svc_model,
+}
+
+
+def get_weight_backend(name, **options):
+    return functools.partial(WEIGHT_BACKENDS[name], **options)
+
+
+def get_weight_backend_id(weight_backend):
+    weight_backend = weight_backend or fit_svc_model
+    if (isinstance(weight_backend, functools.partial)):
+        return f"{weight_backend.func.__name__}{sorted(weight_backend.keywords.items())}"
+    return weight_backend.__name__
+
+
+@profiled
+def fit_weight_model(features, labels, weight_backend=None):
+    add_count('persons', len(labels))
+    weight_backend = weight_backend or fit_svc_model
+    features = np.array(features)
+    if (features.ndim < 2 or features.shape[1] == 0):
+        # criteria without lab values leave nothing to fit on, every person then gets the same weight
+        logger.info("no lab features to fit weights on, using uniform weights")
+        return None
+    return weight_backend(features, np.array(labels))
+
+
+@profiled
+def predict_weights(weight_model, features, labels):
+    if (weight_model is None):
+        return np.ones(len(labels))
+    predictions = weight_model(np.array(features))
+    weights = 1 / (1 + np.abs(predictions - np.array(labels)))
+    return weights
+
+
+@profiled
+def get_weights(features, labels, weight_backend=None):
+    weight_model = fit_weight_model(features, labels, weight_backend)
+    return predict_weights(weight_model, features, labels)
+
+
+def compare_weight_backends(features, labels, weight_backends, reference_backend=None):
+    reference_weights = get_weights(features, labels, reference_backend)
+    report = []
+    for name, weight_backend in weight_backends.items():
+        start = time.perf_counter()
+        weights = get_weights(features, labels, weight_backend)
+        seconds = time.perf_counter() - start
+        diff = np.abs(weights - reference_weights)
+        report.append({
+            'backend': name,
+            'seconds': seconds,
+            'mean_abs_diff': float(diff.mean()),
+            'max_abs_diff': float(diff.max()),
+            'sum_weights_rel_diff': float(abs(weights.sum() - reference_weights.sum()) / reference_weights.sum()),
+            'correlation': float(np.corrcoef(weights, reference_weights)[0, 1]) if weights.std() and reference_weights.std() else float('nan'),
+        })
+    return report
+
+
+class WeightCache:
+    """LRU of trained population weights, optionally backed by .npy files for EHR snapshots with a version."""
+
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # worker processes start from an empty copy, made once per worker by the pool initializer
+    def __getstate__(self):
+        return {'max_entries': self.max_entries, 'cache_dir': self.cache_dir, 'entries': OrderedDict(), 'hits': 0, 'misses': 0}
+
+    def get_key(self, lab_signature, ehr_version, weight_backend):
+        return hashlib.sha256(repr((lab_signature, ehr_version, get_weight_backend_id(weight_backend))).encode()).hexdigest()
+
+    def get(self, key, persistent=True):
+        if (key in self.entries):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        path = self.get_path(key) if persistent else None
+        if (path is not None and os.path.exists(path)):
+            weights = np.load(path)
+            self.remember(key, weights)
+            self.hits += 1
+            return weights
+        self.misses += 1
+        return None
+
+    def put(self, key, weights, persistent=True):
+        self.remember(key, weights)
+        path = self.get_path(key) if persistent else None
+        if (path is not None):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.tmp-{os.getpid()}.npy"
+            np.save(tmp_path, weights)
+            os.replace(tmp_path, path)
+
+    def remember(self, key, weights):
+        self.entries[key] = weights
+        self.entries.move_to_end(key)
+        while (len(self.entries) > self.max_entries):
+            self.entries.popitem(last=False)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npy") if self.cache_dir else None
+
+    def get_report(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
@@ -0,0 +1,271 @@
+import datetime
+import json
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from sqlalchemy import MetaData, create_engine
+from benchmarks.synthetic import DOMAIN_SPECS, generate_database, get_schema_tables, insert_columns, to_dates
+from gist.checkpoint import ScoreCheckpoint
+from gist.cli import score_all_trials
+from gist.core import AGE_CONCEPT_ID, get_elig_matrix, get_gist_score, get_gist_scores, get_lab_signature
+from gist.entities import Person, ConditionOccurrence, Measurement
+from gist.pool import get_pooled_gist_scores
+from gist.repo import CritRepo, EhrRepo
+from gist.results import ResultStore, get_criteria_hash
+from gist.sampling import get_sampled_gist_scores
+from gist.snapshot import DOMAIN_ARRAYS
+from gist.stream import get_streamed_gist_score
+from gist.temporal import TemporalWindow
+from gist.weights import WEIGHT_BACKENDS, WeightCache, get_weight_backend
+
+NUM_PERSONS = 500
+NUM_TRIALS = 4
+
+
+@pytest.fixture(scope='module')
+def weight_backend():
+    return get_weight_backend('linear')
+
+
+@pytest.fixture
+def conn_str(tmp_path):
+    conn_str = f"sqlite:///{tmp_path / 'synthetic.db'}"
+    generate_database(conn_str, NUM_PERSONS, NUM_TRIALS, seed=0)
+    return conn_str
+
+
+@pytest.fixture
+def criteria_by_trial_ids(conn_str):
+    crit_repo = CritRepo(conn_str)
+    return crit_repo.get_criteria_by_trial_ids(crit_repo.get_all_trial_ids())
+
+
+def assert_same_scores(gist_scores, expected_gist_scores):
+    assert [gist_score['trial_id'] for gist_score in gist_scores] == [gist_score['trial_id'] for gist_score in expected_gist_scores]
+    for gist_score, expected_gist_score in zip(gist_scores, expected_gist_scores):
+        assert [s_gist_score['concept_id'] for s_gist_score in gist_score['s_gist_scores']] == [s_gist_score['concept_id'] for s_gist_score in expected_gist_score['s_gist_scores']]
+        assert [s_gist_score['score'] for s_gist_score in gist_score['s_gist_scores']] == pytest.approx([s_gist_score['score'] for s_gist_score in expected_gist_score['s_gist_scores']])
+        assert gist_score['m_gist_score'] == pytest.approx(expected_gist_score['m_gist_score'])
+
+
+def assert_same_snapshots(snapshot, expected_snapshot):
+    assert np.array_equal(snapshot.person_ids, expected_snapshot.person_ids)
+    assert np.array_equal(snapshot.year_of_birth, expected_snapshot.year_of_birth)
+    assert snapshot.domains.keys() == expected_snapshot.domains.keys()
+    for domain_id, rows in snapshot.domains.items():
+        for name in DOMAIN_ARRAYS:
+            assert np.array_equal(getattr(rows, name), getattr(expected_snapshot.domains[domain_id], name), equal_nan=True), (domain_id, name)
+        postings, expected_postings = snapshot.get_concept_index().postings[domain_id], expected_snapshot.get_concept_index().postings[domain_id]
+        for name in ('concept_ids', 'offsets', 'person_indices'):
+            assert np.array_equal(getattr(postings, name), getattr(expected_postings, name)), (domain_id, name)
+
+
+def test_snapshot_orm_and_pushdown_agree(conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    snapshot_scores = get_gist_scores(criteria_by_trial_ids, ehr_repo.get_ehr_snapshot(), weight_backend)
+
+    ehr = ehr_repo.get_ehr()
+    orm_scores = [get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr, weight_backend) for criteria_by_trial_id in criteria_by_trial_ids]
+    assert_same_scores(orm_scores, snapshot_scores)
+
+    pushdown_scores = [get_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], ehr_repo.get_ehr_elig_flags(criteria_by_trial_id['criteria']), weight_backend) for criteria_by_trial_id in criteria_by_trial_ids]
+    assert_same_scores(pushdown_scores, snapshot_scores)
+
+
+def test_refreshed_snapshot_matches_rebuild(conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    tables = get_schema_tables(MetaData())
+    engine = create_engine(conn_str)
+    condition_concept_id = DOMAIN_SPECS['Condition'][5]
+    lab_concept_id = DOMAIN_SPECS['Measurement'][5]
+    dates = to_dates(np.array([100, 200, 300]))
+    with engine.begin() as conn:
+        # a condition written before its person, which the snapshot drops and the refresh has to read once the person exists
+        insert_columns(conn, tables[ConditionOccurrence], {
+            'condition_occurrence_id': np.array([100000]),
+            'person_id': np.array([NUM_PERSONS + 1]),
+            'condition_concept_id': np.array([condition_concept_id + 2]),
+            'condition_start_date': dates[:1],
+        })
+    snapshot = ehr_repo.get_ehr_snapshot()
+
+    with engine.begin() as conn:
+        insert_columns(conn, tables[Person], {'person_id': np.array([NUM_PERSONS + 1]), 'year_of_birth': np.array([1970]), 'gender_source_concept_id': np.array([8507])})
+        insert_columns(conn, tables[ConditionOccurrence], {
+            'condition_occurrence_id': np.array([100001, 100002, 100003]),
+            'person_id': np.array([NUM_PERSONS + 1, 1, NUM_PERSONS + 1]),
+            'condition_concept_id': np.array([condition_concept_id, condition_concept_id, condition_concept_id + 1]),
+            'condition_start_date': dates,
+        })
+        insert_columns(conn, tables[Measurement], {
+            'measurement_id': np.array([100001, 100002]),
+            'person_id': np.array([2, NUM_PERSONS + 1]),
+            'measurement_concept_id': np.array([lab_concept_id, lab_concept_id]),
+            'measurement_date': dates[:2],
+            'value_as_number': np.array([42.0, 43.0]),
+        })
+
+    refreshed = ehr_repo.refresh_ehr_snapshot(snapshot)
+    rebuilt = ehr_repo.get_ehr_snapshot()
+    assert len(refreshed) == NUM_PERSONS + 1
+    assert np.diff(refreshed.domains['Condition'].offsets)[-1] == 3
+    assert_same_snapshots(refreshed, rebuilt)
+    assert np.array_equal(refreshed.lab_values(lab_concept_id), rebuilt.lab_values(lab_concept_id), equal_nan=True)
+    assert_same_scores(get_gist_scores(criteria_by_trial_ids, refreshed, weight_backend), get_gist_scores(criteria_by_trial_ids, rebuilt, weight_backend))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 37, NUM_PERSONS])
+def test_chunked_scores_match_full(conn_str, criteria_by_trial_ids, weight_backend, chunk_size):
+    ehr_repo = EhrRepo(conn_str)
+    full_scores = get_gist_scores(criteria_by_trial_ids, ehr_repo.get_ehr_snapshot(), weight_backend)
+    chunked_scores = [get_streamed_gist_score(criteria_by_trial_id['trial_id'], criteria_by_trial_id['criteria'], lambda: ehr_repo.iter_ehr_snapshots(chunk_size), weight_backend) for criteria_by_trial_id in criteria_by_trial_ids]
+    assert_same_scores(chunked_scores, full_scores)
+
+
+def test_sampled_scores_at_full_fraction_are_exact(conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    exact_scores = get_gist_scores(criteria_by_trial_ids, ehr_repo.get_ehr_snapshot(), weight_backend)
+    sampled_scores = get_sampled_gist_scores(criteria_by_trial_ids, ehr_repo, 1.0, weight_backend=weight_backend)
+    assert_same_scores(sampled_scores, exact_scores)
+    for gist_score in sampled_scores:
+        # the whole population leaves no sampling error
+        assert gist_score['m_gist_ci'] == pytest.approx([gist_score['m_gist_score']] * 2)
+
+
+def test_temporal_window_matches_brute_force(conn_str):
+    ehr_repo = EhrRepo(conn_str)
+    snapshot = ehr_repo.get_ehr_snapshot()
+    index_date = datetime.date(2016, 1, 1)
+    lookback_days = {'Condition': 365, 'Measurement': 90}
+    windowed = TemporalWindow(index_date, lookback_days).apply(snapshot)
+
+    index_day = np.datetime64(index_date, 'D')
+    for domain_id, rows in snapshot.domains.items():
+        first_day = index_day - lookback_days[domain_id] if domain_id in lookback_days else np.datetime64('1900-01-01')
+        for person in range(len(snapshot)):
+            start, end = rows.offsets[person], rows.offsets[person + 1]
+            in_window = (rows.dates[start:end] >= first_day) & (rows.dates[start:end] <= index_day)
+            windowed_rows = windowed.domains[domain_id]
+            windowed_start, windowed_end = windowed_rows.offsets[person], windowed_rows.offsets[person + 1]
+            expected = sorted(zip(rows.dates[start:end][in_window].tolist(), rows.concept_ids[start:end][in_window].tolist()))
+            assert sorted(zip(windowed_rows.dates[windowed_start:windowed_end].tolist(), windowed_rows.concept_ids[windowed_start:windowed_end].tolist())) == expected
+
+
+def test_temporal_window_today_matches_baseline(conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    snapshot = ehr_repo.get_ehr_snapshot()
+    windowed = TemporalWindow(datetime.date.today()).apply(snapshot)
+    windowed.lab_value_policy = snapshot.lab_value_policy
+    assert_same_scores(get_gist_scores(criteria_by_trial_ids, windowed, weight_backend), get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend))
+
+
+def test_temporal_window_without_lab_values_scores_every_trial(conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    snapshot = ehr_repo.get_ehr_snapshot()
+    # a one day lookback leaves none of the trials' labs with a value
+    windowed = TemporalWindow(datetime.date(2016, 1, 1), {'Measurement': 1}).apply(snapshot)
+    windowed.lab_value_policy = snapshot.lab_value_policy
+    lab_concept_ids = {criterion.concept_id for criteria_by_trial_id in criteria_by_trial_ids for criterion in criteria_by_trial_id['criteria'] if criterion.domain_id == 'Measurement'}
+    assert all(np.isnan(windowed.lab_values(lab_concept_id)).all() for lab_concept_id in lab_concept_ids)
+
+    gist_scores = get_gist_scores(criteria_by_trial_ids, windowed, weight_backend)
+    assert [gist_score['trial_id'] for gist_score in gist_scores] == [criteria_by_trial_id['trial_id'] for criteria_by_trial_id in criteria_by_trial_ids]
+    for gist_score in gist_scores:
+        assert all(np.isfinite(s_gist_score['score']) for s_gist_score in gist_score['s_gist_scores'])
+        assert all(s_gist_score['score'] == 0 for s_gist_score in gist_score['s_gist_scores'] if s_gist_score['concept_id'] in lab_concept_ids)
+        assert np.isfinite(gist_score['m_gist_score'])
+
+
+def test_result_store_returns_scores_of_unchanged_criteria(tmp_path, conn_str, criteria_by_trial_ids, weight_backend):
+    gist_scores = get_gist_scores(criteria_by_trial_ids, EhrRepo(conn_str).get_ehr_snapshot(), weight_backend)
+    result_conn_str = f"sqlite:///{tmp_path / 'results.db'}"
+    ResultStore(result_conn_str, 'ehr-1', 'settings-1').put_scores(criteria_by_trial_ids, gist_scores)
+
+    stored_scores = ResultStore(result_conn_str, 'ehr-1', 'settings-1').get_scores(criteria_by_trial_ids)
+    assert_same_scores([stored_scores[gist_score['trial_id']] for gist_score in gist_scores], gist_scores)
+    assert ResultStore(result_conn_str, 'ehr-2', 'settings-1').get_scores(criteria_by_trial_ids) == {}
+    changed_criteria_by_trial_ids = [{'trial_id': criteria_by_trial_ids[0]['trial_id'], 'criteria': criteria_by_trial_ids[0]['criteria'][1:]}]
+    assert ResultStore(result_conn_str, 'ehr-1', 'settings-1').get_scores(changed_criteria_by_trial_ids) == {}
+
+    # criteria without lab bounds sort next to ones with bounds
+    unbounded = SimpleNamespace(concept_id=100000, domain_id='Condition', cat_elig=1, lab_elig_min=None, lab_elig_max=None)
+    bounded = SimpleNamespace(concept_id=100000, domain_id='Condition', cat_elig=1, lab_elig_min=0, lab_elig_max=1)
+    assert get_criteria_hash([unbounded, bounded]) == get_criteria_hash([bounded, unbounded])
+
+
+def test_orm_elig_matrix_keeps_criteria_sharing_a_concept_id_apart(conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    snapshot = ehr_repo.get_ehr_snapshot()
+    ehr = ehr_repo.get_ehr()
+    age_criteria = [criterion for criteria_by_trial_id in criteria_by_trial_ids for criterion in criteria_by_trial_id['criteria'] if criterion.concept_id == AGE_CONCEPT_ID]
+    assert len({(criterion.lab_elig_min, criterion.lab_elig_max) for criterion in age_criteria}) > 1
+    assert np.array_equal(get_elig_matrix(age_criteria, ehr), get_elig_matrix(age_criteria, snapshot))
+    # scored together, the trials' age criteria share a concept_id in one deduplicated matrix
+    assert_same_scores(get_gist_scores(criteria_by_trial_ids, ehr, weight_backend), get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend))
+
+
+@pytest.mark.parametrize('backend_name', sorted(WEIGHT_BACKENDS))
+def test_trial_without_lab_criteria_gets_uniform_weights(conn_str, criteria_by_trial_ids, backend_name):
+    ehr_repo = EhrRepo(conn_str)
+    criteria = [criterion for criterion in criteria_by_trial_ids[0]['criteria'] if criterion.domain_id != 'Measurement']
+    assert any(criterion.concept_id == AGE_CONCEPT_ID for criterion in criteria)
+    snapshot_score = get_gist_score('no-labs', criteria, ehr_repo.get_ehr_snapshot(), get_weight_backend(backend_name))
+    orm_score = get_gist_score('no-labs', criteria, ehr_repo.get_ehr(), get_weight_backend(backend_name))
+    assert_same_scores([orm_score], [snapshot_score])
+    # with every person weighted alike the score is the eligible share of the population
+    elig_matrix = get_elig_matrix(criteria, ehr_repo.get_ehr_snapshot())
+    assert [s_gist_score['score'] for s_gist_score in snapshot_score['s_gist_scores']] == pytest.approx(elig_matrix.mean(axis=0).tolist())
+
+
+def test_pooled_scores_match_sequential(conn_str, criteria_by_trial_ids, weight_backend):
+    snapshot = EhrRepo(conn_str).get_ehr_snapshot()
+    sequential_scores = get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend)
+    weight_cache = WeightCache()
+    pooled_scores = get_pooled_gist_scores(criteria_by_trial_ids, snapshot, 2, weight_backend, weight_cache)
+    assert_same_scores(pooled_scores, sequential_scores)
+    # the workers' cache counts are added to the parent's
+    assert 0 < weight_cache.hits + weight_cache.misses <= len(criteria_by_trial_ids)
+
+
+def test_weight_cache_hits_memory_then_disk(tmp_path, conn_str, criteria_by_trial_ids, weight_backend):
+    snapshot = EhrRepo(conn_str).get_ehr_snapshot()
+    snapshot.version = 'ehr-1'
+    num_signatures = len({get_lab_signature(criteria_by_trial_id['criteria']) for criteria_by_trial_id in criteria_by_trial_ids})
+    weight_cache = WeightCache(cache_dir=str(tmp_path / 'weights'))
+    expected_scores = get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend, weight_cache)
+    assert weight_cache.get_report() == {'hits': 0, 'misses': num_signatures, 'entries': num_signatures}
+    assert_same_scores(get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend, weight_cache), expected_scores)
+    assert weight_cache.hits == num_signatures
+
+    restored_cache = WeightCache(cache_dir=str(tmp_path / 'weights'))
+    assert_same_scores(get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend, restored_cache), expected_scores)
+    assert restored_cache.get_report() == {'hits': num_signatures, 'misses': 0, 'entries': num_signatures}
+
+    snapshot.version = 'ehr-2'
+    get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend, restored_cache)
+    assert restored_cache.misses == num_signatures
+
+
+def test_checkpoint_resume_skips_scored_and_retries_failed_trials(tmp_path, conn_str, criteria_by_trial_ids, weight_backend):
+    ehr_repo = EhrRepo(conn_str)
+    snapshot = ehr_repo.get_ehr_snapshot()
+    expected_scores = get_gist_scores(criteria_by_trial_ids, snapshot, weight_backend)
+    trial_ids = [criteria_by_trial_id['trial_id'] for criteria_by_trial_id in criteria_by_trial_ids]
+    checkpoint_path = str(tmp_path / 'checkpoint.jsonl')
+    with open(checkpoint_path, 'w') as checkpoint_file:
+        checkpoint_file.write(json.dumps(expected_scores[0]) + '\n')
+        checkpoint_file.write(json.dumps({'trial_id': trial_ids[1], 'error': 'ZeroDivisionError: division by zero'}) + '\n')
+        # a crash during the last write
+        checkpoint_file.write('{"trial_id": "NCT')
+    checkpoint = ScoreCheckpoint(checkpoint_path)
+    assert trial_ids[0] in checkpoint and trial_ids[1] not in checkpoint
+    assert checkpoint.num_errors == 1
+
+    score_all_trials(CritRepo(conn_str), ehr_repo, lambda: snapshot, None, 2, checkpoint_path, False, None, 1, weight_backend, None)
+    with open(checkpoint_path) as checkpoint_file:
+        gist_scores = [json.loads(line) for line in checkpoint_file]
+    assert [gist_score['trial_id'] for gist_score in gist_scores] == [trial_ids[0], trial_ids[1]] + trial_ids[1:]
+    assert_same_scores(gist_scores[:1] + gist_scores[2:], expected_scores)
+    checkpoint = ScoreCheckpoint(checkpoint_path)
+    assert len(checkpoint) == len(trial_ids)
+    assert checkpoint.num_errors == 0